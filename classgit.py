@@ -11,15 +11,72 @@
 """
 
 import os
+import sys
+import argparse
+import functools
+import hashlib
+import json
+import re
+import select
+import signal
+import sqlite3
+import struct
 import subprocess
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import closing, contextmanager, nullcontext
 from pathlib import Path
+import platform
 import shutil
 import tempfile
 
-# -----
-# logo intro
-# -----
-print(r"""
+pyrage = None  # optional, imported on first use by load_pyrage()
+zstandard = None  # optional, imported on first use by load_zstandard()
+
+
+# -----------------------------
+# Configuration
+# -----------------------------
+SYNCED_REF = "refs/classgit/synced"  # last commit materialized in COURSES_DIR
+SNAPSHOT_REF = "refs/classgit/snapshot"  # commit SNAPSHOT_INDEX was last written for
+SNAPSHOT_MESSAGE = "Snapshot: update courses and README"
+EMPTY_TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"  # git's id for a tree with nothing in it
+SNAPSHOT_HISTORY = 20  # snapshots kept on the remote before history starts over
+TMP_SUFFIX = ".classgit-tmp"
+
+def set_workspace_paths(local_dir):
+    """Point every path ClassGit uses at the workspace in local_dir."""
+    global LOCAL_DIR, CONFIG_DIR, COURSES_DIR, AGE_KEY_PATH, REPO_FILE, PUBLIC_KEY_FILE
+    global PUSH_PENDING_FILE, SNAPSHOT_INDEX, MAINTENANCE_LOG, MAINTENANCE_LOCK, INDEX_PATH
+    global BACKEND_AUTO_FILE, PROFILE_REPORT, HISTORY_PATH, WATCH_STATE
+    LOCAL_DIR = Path(local_dir)
+    CONFIG_DIR = LOCAL_DIR / "config"
+    COURSES_DIR = LOCAL_DIR / "courses"
+    AGE_KEY_PATH = CONFIG_DIR / "age_key.txt"
+    REPO_FILE = CONFIG_DIR / "repo_url.txt"
+    PUBLIC_KEY_FILE = CONFIG_DIR / "public_key.txt"
+    PUSH_PENDING_FILE = CONFIG_DIR / "push_pending"
+    SNAPSHOT_INDEX = LOCAL_DIR / ".git" / "classgit-index"
+    MAINTENANCE_LOG = CONFIG_DIR / "maintenance.jsonl"
+    MAINTENANCE_LOCK = LOCAL_DIR / ".git" / "classgit-maintenance.lock"
+    INDEX_PATH = CONFIG_DIR / "index.sqlite"
+    BACKEND_AUTO_FILE = CONFIG_DIR / "backend_auto.txt"
+    PROFILE_REPORT = CONFIG_DIR / "profile.json"
+    HISTORY_PATH = CONFIG_DIR / "history.sqlite"
+    WATCH_STATE = CONFIG_DIR / "watch.json"
+
+set_workspace_paths(Path.home() / "ClassGit")
+
+JOBS = os.cpu_count() or 1  # parallel encrypt/decrypt workers, see --jobs
+HASH_BUFFER_SIZE = 1 << 20
+QUIET = False  # --quiet/--json: keep git's progress chatter off the terminal too
+
+# exit codes of the command line, for scripts
+EXIT_OK, EXIT_FAILED, EXIT_USAGE, EXIT_NOT_SET_UP, EXIT_BUSY = 0, 1, 2, 3, 4
+
+LOGO = r"""
 ░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░
 ░░░░░░░▒░░░░░░░░░░░░░░░▓░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░
 ░░░░░░░░░░░░░░░░░░░░░░█▓▓█▓▓█▓▓▓█░░░░░░░░░░░░░░░░░░░░░░
@@ -48,43 +105,1913 @@ print(r"""
 ░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░
 ░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░
 ░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░░
-""")
-
-# -----------------------------
-# Configuration
-# -----------------------------
-LOCAL_DIR = Path.home() / "ClassGit"
-CONFIG_DIR = LOCAL_DIR / "config"
-COURSES_DIR = LOCAL_DIR / "courses"
-AGE_KEY_PATH = CONFIG_DIR / "age_key.txt"
-REPO_FILE = CONFIG_DIR / "repo_url.txt"
-PUBLIC_KEY_FILE = CONFIG_DIR / "public_key.txt"
+"""
 
 # -----------------------------
 # Utility Functions
 # -----------------------------
+class ClassGitError(Exception):
+    """Base of the errors ClassGit raises instead of exiting."""
+
+class CommandError(ClassGitError):
+    """A shell command run() started failed."""
+
+class NotSetUpError(ClassGitError):
+    """The workspace has no key, repository URL or git repository yet."""
+
+class UsageError(ClassGitError):
+    """A command lacks something it would otherwise have to ask for."""
+
+class BusyError(ClassGitError):
+    """Another process already runs the watcher or maintenance."""
+
+class SyncError(ClassGitError):
+    """A push or pull failed; result is its RunRecord."""
+
+    def __init__(self, result):
+        super().__init__(result.error or f"{result.command} failed")
+        self.result = result
+
 def run(cmd, cwd=None):
     result = subprocess.run(cmd, shell=True, cwd=cwd)
     if result.returncode != 0:
         print(f"Error running: {cmd}")
-        exit(1)
-
-def encrypt_file(file_path, recipient, output_path):
-    subprocess.run([
-        "age",
-        "-r", recipient,
-        "-o", str(output_path),
-        str(file_path)
-    ], check=True)
-
-def decrypt_file(file_path, key_path, output_path):
-    subprocess.run([
-        "age",
-        "-d",
-        "-i", str(key_path),
-        "-o", str(output_path),
-        str(file_path)
-    ], check=True)
+        raise CommandError(f"command failed with status {result.returncode}: {cmd}")
+
+def git_output(*args):
+    """Output of a read-only git command in LOCAL_DIR, or None if it failed."""
+    result = subprocess.run(["git", *args], cwd=LOCAL_DIR, capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def write_if_changed(path, content):
+    """Write content to path unless it already holds exactly that; True if written."""
+    path = Path(path)
+    if path.exists() and path.read_text() == content:
+        return False
+    path.write_text(content)
+    return True
+
+def read_setting(name, default):
+    """A setting stored as config/<name>.txt, like the repo URL and public key."""
+    path = CONFIG_DIR / f"{name}.txt"
+    return path.read_text().strip() if path.exists() else default
+
+def storage_mode():
+    """How ciphertext is kept locally, from config/storage.txt.
+
+    "mirror" (the default) keeps every .age file in LOCAL_DIR/encrypted;
+    "objects" streams ciphertext straight into git's object store and
+    keeps no copy in the working directory.
+    """
+    mode = read_setting("storage", "mirror")
+    if mode not in ("mirror", "objects"):
+        raise ValueError(f"Unknown storage mode {mode!r} in config/storage.txt, "
+                         "expected mirror or objects")
+    return mode
+
+# -----------------------------
+# Crypto backends
+# -----------------------------
+# Both backends speak the age v1 format, so files written by one are read
+# by the other. config/backend.txt can force "cli" or "pyrage"; by default
+# ("auto") a short benchmark picks the faster one and caches its choice in
+# config/backend_auto.txt.
+def load_pyrage():
+    """The pyrage module, or None if it isn't installed."""
+    global pyrage
+    if pyrage is None:
+        try:
+            import pyrage as module
+        except ImportError:
+            return None
+        pyrage = module
+    return pyrage
+
+class AgeCli:
+    """The age command line tool, one process per file."""
+    name = "cli"
+
+    def __init__(self, recipient, key_path):
+        self.recipient = recipient
+        self.key_path = key_path
+
+    def encrypt(self, src, dst):
+        subprocess.run(["age", "-r", self.recipient, "-o", str(dst), str(src)], check=True)
+
+    def decrypt(self, src, dst):
+        subprocess.run(["age", "-d", "-i", str(self.key_path), "-o", str(dst), str(src)],
+                       check=True)
+
+    def encrypt_to(self, src, out):
+        subprocess.run(["age", "-r", self.recipient, str(src)], stdout=out, check=True)
+
+    def decrypt_bytes(self, data, dst):
+        subprocess.run(["age", "-d", "-i", str(self.key_path), "-o", str(dst)], input=data,
+                       check=True)
+
+    def decrypt_from(self, src, dst):
+        subprocess.run(["age", "-d", "-i", str(self.key_path), "-o", str(dst)], stdin=src,
+                       check=True)
+
+    def encrypt_data_to(self, data, out):
+        subprocess.run(["age", "-r", self.recipient], input=data, stdout=out, check=True)
+
+    def decrypt_data(self, data):
+        return subprocess.run(["age", "-d", "-i", str(self.key_path)], input=data,
+                              stdout=subprocess.PIPE, check=True).stdout
+
+class AgePyrage:
+    """age inside this process through pyrage; keys are parsed once, not per file."""
+    name = "pyrage"
+
+    def __init__(self, recipient, key_path):
+        if load_pyrage() is None:
+            raise RuntimeError("pyrage is not installed (pip install pyrage)")
+        self.recipients = [self.parse_recipient(recipient)] if recipient else []
+        self.identities = []
+        if Path(key_path).exists():
+            for line in Path(key_path).read_text().splitlines():
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    self.identities.append(pyrage.x25519.Identity.from_str(line))
+
+    @staticmethod
+    def parse_recipient(recipient):
+        if recipient.startswith("ssh-"):
+            return pyrage.ssh.Recipient.from_str(recipient)
+        return pyrage.x25519.Recipient.from_str(recipient)
+
+    def encrypt(self, src, dst):
+        pyrage.encrypt_file(str(src), str(dst), self.recipients)
+
+    def decrypt(self, src, dst):
+        pyrage.decrypt_file(str(src), str(dst), self.identities)
+
+    def encrypt_to(self, src, out):
+        with open(src, "rb") as f:
+            pyrage.encrypt_io(f, out, self.recipients)
+
+    def decrypt_bytes(self, data, dst):
+        Path(dst).write_bytes(pyrage.decrypt(data, self.identities))
+
+    def decrypt_from(self, src, dst):
+        with open(dst, "wb") as out:
+            pyrage.decrypt_io(src, out, self.identities)
+
+    def encrypt_data_to(self, data, out):
+        out.write(pyrage.encrypt(data, self.recipients))
+
+    def decrypt_data(self, data):
+        return pyrage.decrypt(data, self.identities)
+
+BACKENDS = {backend.name: backend for backend in (AgeCli, AgePyrage)}
+
+def benchmark_backends(backends, rounds=16, size=4096):
+    """Seconds each backend takes to round-trip a batch of small files.
+
+    Small files are where the backends differ (process start-up and key
+    parsing), large ones are dominated by the cipher itself. A backend that
+    fails, or can't read what another one wrote, is left out.
+    """
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        plain = tmp / "sample"
+        plain.write_bytes(os.urandom(size))
+        for backend in backends:
+            try:
+                start = time.perf_counter()
+                for i in range(rounds):
+                    backend.encrypt(plain, tmp / f"{backend.name}.age")
+                    backend.decrypt(tmp / f"{backend.name}.age", tmp / f"{backend.name}.out")
+                timings[backend.name] = time.perf_counter() - start
+            except Exception:
+                continue
+        written = list(timings)
+        for backend in backends:
+            for other in written:
+                try:
+                    backend.decrypt(tmp / f"{other}.age", tmp / "check")
+                    readable = (tmp / "check").read_bytes() == plain.read_bytes()
+                except Exception:
+                    readable = False
+                if not readable:
+                    timings.pop(backend.name, None)
+    return timings
+
+def get_backend(recipient=None):
+    recipient = recipient or (get_public_key() if PUBLIC_KEY_FILE.exists() else None)
+    choice = read_setting("backend", "auto")
+    if choice != "auto":
+        if choice not in BACKENDS:
+            raise ValueError(f"Unknown crypto backend {choice!r} in config/backend.txt, "
+                             f"expected auto or one of: {', '.join(BACKENDS)}")
+        return BACKENDS[choice](recipient, AGE_KEY_PATH)
+
+    backends = []
+    for cls in BACKENDS.values():
+        try:
+            backends.append(cls(recipient, AGE_KEY_PATH))
+        except Exception:
+            pass
+    by_name = {backend.name: backend for backend in backends}
+    cached = BACKEND_AUTO_FILE.read_text().strip() if BACKEND_AUTO_FILE.exists() else None
+    if cached in by_name:
+        return by_name[cached]
+    if len(backends) == 1 or not (recipient and AGE_KEY_PATH.exists()):
+        return by_name.get("cli", backends[0])
+
+    timings = benchmark_backends(backends)
+    if not timings:
+        return by_name["cli"]
+    best = min(timings, key=timings.get)
+    print("⚙️ Crypto backend benchmark: " + ", ".join(
+        f"{name} {seconds * 1000:.0f} ms" for name, seconds in sorted(timings.items()))
+        + f" → using {best}")
+    BACKEND_AUTO_FILE.write_text(best)
+    return by_name[best]
+
+# -----------------------------
+# Worker pool
+# -----------------------------
+def _collect(future):
+    try:
+        return future.result(), None
+    except Exception as e:
+        return None, e
+
+def run_parallel(fn, items, size=None, jobs=None):
+    """Run fn over items on a bounded pool of JOBS worker threads.
+
+    Items are taken from the iterable a window at a time and each window is
+    submitted largest-first (by size(item)), so a huge PDF starts early
+    instead of stalling the tail of the run. Results are yielded in input
+    order as (item, result, error) tuples, whatever order workers finish in.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    jobs = max(1, jobs or JOBS)
+    window = jobs * 16
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        while True:
+            batch = [item for _, item in zip(range(window), items)]
+            if batch:
+                order = range(len(batch))
+                if size is not None:
+                    order = sorted(order, key=lambda i: size(batch[i]), reverse=True)
+                futures = [None] * len(batch)
+                for i in order:
+                    futures[i] = pool.submit(fn, batch[i])
+                pending.append((batch, futures))
+            # keep one window queued behind the one being reported
+            if pending and (len(pending) > 1 or not batch):
+                done_batch, done_futures = pending.popleft()
+                for item, future in zip(done_batch, done_futures):
+                    yield (item, *_collect(future))
+            if not batch and not pending:
+                break
+
+# -----------------------------
+# Profiling
+# -----------------------------
+# With --profile, push and pull time each of their stages, every process
+# they start (git, age) and every file they encrypt or decrypt, then print a
+# summary and keep the full report in config/profile.json.
+PROFILE_SLOWEST = 10  # files listed by name in the report
+PROFILING = False  # set by --profile
+PROFILE = None  # the Profile being recorded, if any
+TIMING_HOOK = None  # fn(stage, seconds), called as each stage ends (Workspace on_stage)
+PROGRESS_HOOK = None  # fn(event, path, size) for each file moved (Workspace on_progress)
+_Popen = subprocess.Popen
+
+class Profile:
+    def __init__(self, command):
+        self.command = command
+        self.start = time.perf_counter()
+        self.stage = None  # stage running now; workers and processes are charged to it
+        self.stages = []  # (name, seconds)
+        self.processes = []  # (stage, command, seconds)
+        self.files = []  # (operation, path, bytes, seconds)
+
+class ProfiledPopen(_Popen):
+    """Popen that reports how long each process lived to the running Profile."""
+
+    def __init__(self, args, *rest, **kwargs):
+        self.profile = PROFILE
+        self.profile_stage = PROFILE.stage if PROFILE else None
+        self.profile_start = time.perf_counter()
+        super().__init__(args, *rest, **kwargs)
+
+    def wait(self, timeout=None):
+        running = self.returncode is None
+        code = super().wait(timeout)
+        if running and self.profile is not None:
+            words = self.args.split() if isinstance(self.args, str) else [str(a) for a in self.args]
+            name = " ".join(words[:2]) if Path(words[0]).name == "git" else Path(words[0]).name
+            self.profile.processes.append((self.profile_stage, name,
+                                           time.perf_counter() - self.profile_start))
+        return code
+
+@contextmanager
+def stage(name):
+    """Time a stage of push or pull for the run history and --profile."""
+    profile = PROFILE
+    if profile is not None:
+        previous, profile.stage = profile.stage, name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if RUN is not None:
+            RUN.stages[name] = RUN.stages.get(name, 0) + seconds
+        if TIMING_HOOK is not None:
+            TIMING_HOOK(name, seconds)
+        if profile is not None:
+            profile.stages.append((name, seconds))
+            profile.stage = previous
+
+def report_progress(event, path, size=0):
+    """Tell the progress hook about a file: "encrypted", "moved", "removed"
+    (push), "decrypted" or "deleted" (pull)."""
+    if PROGRESS_HOOK is not None:
+        PROGRESS_HOOK(event, path, size)
+
+@contextmanager
+def timed_file(operation, path, size):
+    """Time one file's encryption or decryption when profiling."""
+    if PROFILE is None:
+        yield
+        return
+    start = time.perf_counter()
+    yield
+    PROFILE.files.append((operation, str(path), size, time.perf_counter() - start))
+
+def latency_histogram(seconds):
+    """Counts per power-of-two millisecond bucket: "<1 ms", "1-2 ms", "2-4 ms"..."""
+    buckets = {}
+    for s in sorted(seconds):
+        ms = s * 1000
+        if ms < 1:
+            label = "<1 ms"
+        else:
+            low = 1 << (int(ms).bit_length() - 1)
+            label = f"{low}-{low * 2} ms"
+        buckets[label] = buckets.get(label, 0) + 1
+    return buckets
+
+def profile_report(profile):
+    total = time.perf_counter() - profile.start
+    stages = []
+    for name, seconds in profile.stages:
+        mine = [p for p in profile.processes if p[0] == name]
+        stages.append({"name": name, "seconds": round(seconds, 6),
+                       "processes": len(mine),
+                       "process_seconds": round(sum(p[2] for p in mine), 6)})
+    processes = {}
+    for _, name, seconds in profile.processes:
+        entry = processes.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+        entry["count"] += 1
+        entry["seconds"] = round(entry["seconds"] + seconds, 6)
+        entry["max_seconds"] = round(max(entry["max_seconds"], seconds), 6)
+    files = {}
+    for operation in sorted({f[0] for f in profile.files}):
+        mine = [f for f in profile.files if f[0] == operation]
+        files[operation] = {
+            "count": len(mine),
+            "bytes": sum(f[2] for f in mine),
+            "seconds": round(sum(f[3] for f in mine), 6),
+            "histogram": latency_histogram(f[3] for f in mine),
+            "slowest": [{"path": path, "bytes": size, "seconds": round(seconds, 6)}
+                        for _, path, size, seconds in
+                        sorted(mine, key=lambda f: f[3], reverse=True)[:PROFILE_SLOWEST]],
+        }
+    return {"command": profile.command, "time": time.time(), "jobs": JOBS,
+            "seconds": round(total, 6), "stages": stages, "processes": processes,
+            "files": files}
+
+def print_profile(report):
+    total = report["seconds"] or 1e-9
+    print(f"\n⏱️ Profile of {report['command']}: {report['seconds']:.3f} s with {report['jobs']} jobs")
+    print(f"  {'stage':<18} {'seconds':>9} {'share':>6} {'processes':>10} {'in processes':>13}")
+    for s in report["stages"]:
+        print(f"  {s['name']:<18} {s['seconds']:>9.3f} {s['seconds'] / total:>6.0%} "
+              f"{s['processes']:>10} {s['process_seconds']:>12.3f}s")
+    if report["processes"]:
+        print("  processes: " + ", ".join(
+            f"{name} ×{p['count']} {p['seconds']:.3f}s"
+            for name, p in sorted(report["processes"].items(), key=lambda kv: -kv[1]["seconds"])))
+    for operation, f in report["files"].items():
+        print(f"  {operation}: {f['count']} files, {f['bytes'] / (1 << 20):.1f} MiB, "
+              f"{f['seconds']:.3f} s of worker time")
+        widest = max(f["histogram"].values())
+        for label, count in f["histogram"].items():
+            print(f"    {label:>14} {count:>6} {'█' * max(1, round(30 * count / widest))}")
+        print("    slowest:")
+        for slow in f["slowest"]:
+            print(f"      {slow['seconds'] * 1000:>9.1f} ms {slow['bytes'] / 1024:>10.0f} KiB  {slow['path']}")
+
+def profiled(command, fn, *args):
+    """Run fn(*args); with --profile, report where its time went."""
+    global PROFILE
+    if not PROFILING:
+        return fn(*args)
+    PROFILE = Profile(command)
+    subprocess.Popen = ProfiledPopen
+    try:
+        return fn(*args)
+    finally:
+        subprocess.Popen = _Popen
+        report = profile_report(PROFILE)
+        PROFILE = None
+        print_profile(report)
+        if CONFIG_DIR.exists():
+            PROFILE_REPORT.write_text(json.dumps(report, indent=2))
+            print(f"📄 Full report written to {PROFILE_REPORT}")
+
+# -----------------------------
+# File index
+# -----------------------------
+# One row per course file, like git's index: the stat data seen when the
+# file was last hashed, its content hash, and the .age file (stat and git
+# blob id) that holds that content. A file whose stat still matches is
+# unchanged without being read; one whose stat moved is re-hashed, and
+# re-encrypted only if the hash moved too (a pull rewrites mtimes, not
+# contents).
+_INDEX_MIGRATIONS = [
+    """
+    CREATE TABLE files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        hash TEXT NOT NULL,
+        enc_size INTEGER,
+        enc_mtime_ns INTEGER
+    ) WITHOUT ROWID;
+    """,
+    # git blob id of the ciphertext in the last snapshot holding this content
+    "ALTER TABLE files ADD COLUMN blob TEXT;",
+    # set while blob is only in a snapshot that hasn't reached the remote yet
+    "ALTER TABLE files ADD COLUMN pending INTEGER NOT NULL DEFAULT 0;",
+    # paths under COURSES_DIR changed since they were last staged, kept by `watch`
+    "CREATE TABLE journal (path TEXT PRIMARY KEY, seq INTEGER NOT NULL) WITHOUT ROWID;",
+    # space-separated names of the chunks a file stored in chunks is made of
+    "ALTER TABLE files ADD COLUMN chunks TEXT;",
+    # directory whose bundle holds the file, for files stored in a bundle
+    "ALTER TABLE files ADD COLUMN bundle TEXT;",
+    # ciphertext reuse by content (see Duplicates), and the path layout
+    # tree of each content layout tree met so far
+    """
+    CREATE INDEX files_by_hash ON files (hash);
+    CREATE TABLE layouts (tree TEXT PRIMARY KEY, logical TEXT NOT NULL) WITHOUT ROWID;
+    """,
+    # files moved within courses/, told by their inode (see Duplicates.digest_of)
+    "CREATE INDEX files_by_ino ON files (ino);",
+]
+
+# mtimes this close to the time a row is written can still change within
+# the filesystem's timestamp granularity, see git's "racy clean" problem
+RACY_WINDOW_NS = 2_000_000_000
+
+def open_db(path, migrations):
+    """Connect to a sqlite file, bringing its schema up to date."""
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for number, script in enumerate(migrations[version:], version + 1):
+        db.executescript(script)
+        db.execute(f"PRAGMA user_version = {number}")
+    return db
+
+def open_index():
+    return open_db(INDEX_PATH, _INDEX_MIGRATIONS)
+
+def index_get(db, rel):
+    return db.execute("SELECT * FROM files WHERE path = ?", (rel,)).fetchone()
+
+def index_put(db, rel, st, digest, enc_st, blob, pending=False, chunks=None, bundle=None):
+    mtime_ns = st.st_mtime_ns
+    if time.time_ns() - mtime_ns < RACY_WINDOW_NS:
+        mtime_ns = 0  # never trust this stat, re-hash next time
+    db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+               (rel, st.st_size, mtime_ns, st.st_ino, digest,
+                enc_st and enc_st.st_size, enc_st and enc_st.st_mtime_ns, blob, int(pending),
+                chunks, bundle))
+
+def journal_add(db, paths):
+    seq = time.time_ns()  # grows even after rows are cleared, unlike max(seq) + 1
+    db.executemany("INSERT OR REPLACE INTO journal VALUES (?, ?)", ((p, seq) for p in paths))
+
+def journal_version():
+    with closing(open_index()) as index:
+        return index.execute("SELECT max(seq) FROM journal").fetchone()[0]
+
+def read_journal():
+    """(paths, seq): what a running watcher journaled, or None for paths when
+    there is no watcher whose journal can be trusted to be complete."""
+    with closing(open_index()) as index:
+        seq = index.execute("SELECT max(seq) FROM journal").fetchone()[0]
+        if not watcher_ready():
+            return None, seq
+        return [row[0] for row in index.execute("SELECT path FROM journal")], seq
+
+def clear_journal(seq, paths=None):
+    """Forget journal entries up to seq once they are staged (only paths, if
+    given); entries journaled again since then are kept."""
+    if seq is None:
+        return
+    with closing(open_index()) as index, index:
+        if paths is None:
+            index.execute("DELETE FROM journal WHERE seq <= ?", (seq,))
+        else:
+            index.executemany("DELETE FROM journal WHERE path = ? AND seq <= ?",
+                              ((p, seq) for p in paths))
+
+def stat_matches(row, st):
+    return row is not None and (row["size"], row["mtime_ns"], row["ino"]) == (
+        st.st_size, st.st_mtime_ns, st.st_ino)
+
+def is_unchanged(row, path, st):
+    """True if path still holds the content indexed in row, hashing only if its stat moved."""
+    return stat_matches(row, st) or (row is not None and hash_file(path) == row["hash"])
+
+def changed_here(row, path, st):
+    """True if path (stat st, None if it is missing) holds a version this
+    device hasn't pushed: not indexed, staged but not pushed, or edited."""
+    return st is not None and (row is None or bool(row["pending"])
+                               or not is_unchanged(row, path, st))
+
+def enc_matches(row, enc_st):
+    return row is not None and enc_st is not None and (
+        row["enc_size"], row["enc_mtime_ns"]) == (enc_st.st_size, enc_st.st_mtime_ns)
+
+_hash_buffers = threading.local()
+
+def hash_file(path):
+    """BLAKE2b of a file, read through a per-thread reusable buffer."""
+    buf = getattr(_hash_buffers, "buf", None)
+    if buf is None:
+        buf = _hash_buffers.buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+def stat_or_none(path):
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+# -----------------------------
+# Run history
+# -----------------------------
+# Every push and pull leaves a row in config/history.sqlite: when it ran,
+# how long each stage took, how many files and bytes it moved and whether
+# it failed. `metrics` turns that history into a Prometheus textfile for
+# node_exporter's textfile collector.
+_HISTORY_MIGRATIONS = [
+    """
+    CREATE TABLE runs (
+        id INTEGER PRIMARY KEY,
+        command TEXT NOT NULL,
+        started REAL NOT NULL,
+        duration REAL NOT NULL,
+        status TEXT NOT NULL,
+        files INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        deleted INTEGER NOT NULL,
+        failures INTEGER NOT NULL,
+        error TEXT,
+        stages TEXT NOT NULL
+    );
+    CREATE INDEX runs_by_command ON runs (command, started);
+    """,
+]
+RUN_DURATION_BUCKETS = (1, 5, 15, 60, 300, 900, 3600)  # seconds, for the histogram metric
+RUN = None  # the RunRecord of the push or pull in progress
+LAST_RUN = None  # ... and of the last one that finished, for the command line
+
+class RunRecord:
+    """What one push or pull did. status is "ok", "noop" or "failed"."""
+
+    def __init__(self, command):
+        self.command = command
+        self.started = time.time()
+        self.duration = None
+        self.status = "ok"
+        self.error = None
+        self.files = 0  # encrypted by a push, decrypted by a pull
+        self.bytes = 0
+        self.deleted = 0
+        self.failures = 0  # files that could not be processed
+        self.stages = {}  # stage -> seconds
+        self.compression = {}  # file type -> statistics, see Compressor.summary
+        self.conflicts = []  # {"path", "copy"}: this device's version kept by a pull
+
+    def fail(self, error):
+        self.status = "failed"
+        self.error = self.error or error
+
+    def as_dict(self):
+        return {"command": self.command, "status": self.status, "files": self.files,
+                "bytes": self.bytes, "deleted": self.deleted, "failures": self.failures,
+                "duration": round(self.duration or 0, 3), "error": self.error,
+                "stages": {name: round(seconds, 6) for name, seconds in self.stages.items()},
+                "compression": self.compression, "conflicts": self.conflicts}
+
+def recorded(command):
+    """Decorator adding every call of a push/pull function to the run history."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            global RUN, LAST_RUN
+            RUN = RunRecord(command)
+            try:
+                return fn(*args, **kwargs)
+            except BaseException as e:  # includes Ctrl+C
+                RUN.fail(f"{type(e).__name__}: {e}")
+                raise
+            finally:
+                record, RUN = RUN, None
+                record.duration = time.time() - record.started
+                LAST_RUN = record
+                save_run(record)
+        return wrapper
+    return decorate
+
+THROUGHPUT_RUNS = 20  # recent runs estimate_duration goes by
+
+def estimate_duration(command, size):
+    """Seconds a command moving size bytes should take at the throughput of
+    its recent runs that moved something, or None without any."""
+    if not HISTORY_PATH.exists():
+        return None
+    with closing(open_db(HISTORY_PATH, _HISTORY_MIGRATIONS)) as db:
+        moved, seconds = db.execute(
+            "SELECT sum(bytes), sum(duration) FROM (SELECT bytes, duration FROM runs "
+            "WHERE command = ? AND status = 'ok' AND bytes > 0 ORDER BY started DESC LIMIT ?)",
+            (command, THROUGHPUT_RUNS)).fetchone()
+    return size * seconds / moved if moved else None
+
+def save_run(record):
+    if not CONFIG_DIR.exists():
+        return
+    try:
+        with closing(open_db(HISTORY_PATH, _HISTORY_MIGRATIONS)) as db, db:
+            db.execute("INSERT INTO runs (command, started, duration, status, files, bytes, "
+                       "deleted, failures, error, stages) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (record.command, record.started, record.duration,
+                        record.status, record.files, record.bytes, record.deleted,
+                        record.failures, record.error,
+                        json.dumps({k: round(v, 6) for k, v in record.stages.items()})))
+    except sqlite3.Error as e:
+        print(f"⚠️ Could not record this run in {HISTORY_PATH}: {e}")
+
+def prometheus_metrics():
+    """The run history as Prometheus text exposition format (no samples
+    before the first run)."""
+    lines = []
+
+    def sample(name, labels, value):
+        label = ",".join(f'{k}="{v}"' for k, v in labels.items())
+        value = int(value) if float(value).is_integer() else round(value, 6)
+        lines.append(f"classgit_{name}{{{label}}} {value}")
+
+    def metric(name, kind, description, samples):
+        lines.append(f"# HELP classgit_{name} {description}")
+        lines.append(f"# TYPE classgit_{name} {kind}")
+        for labels, value in samples:
+            sample(name, labels, value)
+
+    last, success, counts, totals, durations = {}, {}, [], [], []
+    if HISTORY_PATH.exists():
+        with closing(open_db(HISTORY_PATH, _HISTORY_MIGRATIONS)) as db:
+            last = {row["command"]: row for row in db.execute(
+                "SELECT * FROM runs WHERE id IN (SELECT max(id) FROM runs GROUP BY command)")}
+            success = dict(db.execute("SELECT command, max(started + duration) FROM runs "
+                                      "WHERE status != 'failed' GROUP BY command").fetchall())
+            counts = db.execute("SELECT command, status, count(*) FROM runs "
+                                "GROUP BY command, status").fetchall()
+            totals = db.execute("SELECT command, sum(files), sum(bytes), sum(deleted), "
+                                "sum(failures), sum(duration), count(*) FROM runs "
+                                "GROUP BY command").fetchall()
+            durations = db.execute("SELECT command, duration FROM runs").fetchall()
+
+    cmd = lambda command: {"command": command}
+    metric("last_run_timestamp_seconds", "gauge", "Start time of the latest run.",
+           [(cmd(c), r["started"]) for c, r in last.items()])
+    metric("last_run_duration_seconds", "gauge", "Duration of the latest run.",
+           [(cmd(c), r["duration"]) for c, r in last.items()])
+    metric("last_run_success", "gauge", "1 if the latest run did not fail.",
+           [(cmd(c), int(r["status"] != "failed")) for c, r in last.items()])
+    metric("last_run_files", "gauge", "Files encrypted (push) or decrypted (pull) by the latest run.",
+           [(cmd(c), r["files"]) for c, r in last.items()])
+    metric("last_run_bytes", "gauge", "Bytes moved by the latest run.",
+           [(cmd(c), r["bytes"]) for c, r in last.items()])
+    metric("last_run_stage_duration_seconds", "gauge", "Time spent in each stage of the latest run.",
+           [({"command": c, "stage": stage}, seconds)
+            for c, r in last.items() for stage, seconds in json.loads(r["stages"]).items()])
+    metric("last_success_timestamp_seconds", "gauge", "End time of the latest run that did not fail.",
+           [(cmd(c), t) for c, t in success.items()])
+    metric("runs_total", "counter", "Runs recorded, by outcome.",
+           [({"command": c, "status": status}, n) for c, status, n in counts])
+    metric("files_total", "counter", "Files encrypted (push) or decrypted (pull).",
+           [(cmd(row[0]), row[1]) for row in totals])
+    metric("bytes_total", "counter", "Bytes moved.", [(cmd(row[0]), row[2]) for row in totals])
+    metric("deleted_total", "counter", "Files removed because they were deleted on the other side.",
+           [(cmd(row[0]), row[3]) for row in totals])
+    metric("file_failures_total", "counter", "Files that could not be encrypted or decrypted.",
+           [(cmd(row[0]), row[4]) for row in totals])
+    lines.append("# HELP classgit_run_duration_seconds How long runs took.")
+    lines.append("# TYPE classgit_run_duration_seconds histogram")
+    for c, *_, seconds, count in totals:
+        mine = [d for command, d in durations if command == c]
+        for le in RUN_DURATION_BUCKETS:
+            sample("run_duration_seconds_bucket", {"command": c, "le": le},
+                   sum(d <= le for d in mine))
+        sample("run_duration_seconds_bucket", {"command": c, "le": "+Inf"}, count)
+        sample("run_duration_seconds_sum", cmd(c), seconds)
+        sample("run_duration_seconds_count", cmd(c), count)
+    return "\n".join(lines) + "\n"
+
+def export_metrics(target):
+    """Write the metrics to target ("-" for stdout), atomically so the
+    textfile collector never reads half a file."""
+    text = prometheus_metrics()
+    if str(target) == "-":
+        sys.stdout.write(text)
+        return
+    target = Path(target)
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=".", suffix=TMP_SUFFIX)
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, target)
+
+# -----------------------------
+# Snapshot plumbing
+# -----------------------------
+# Push builds its commit in a private index instead of the repository's own
+# index and working tree. The private index persists between pushes, so a
+# snapshot only hashes the files that changed, and write-tree reuses the
+# cached tree objects of every directory that didn't.
+def snapshot_git(*args, input=None):
+    env = dict(os.environ, GIT_INDEX_FILE=str(SNAPSHOT_INDEX))
+    return subprocess.run(["git", *args], cwd=LOCAL_DIR, env=env, input=input,
+                          capture_output=True, text=True, check=True).stdout
+
+def prepare_snapshot_index():
+    """Make the private index describe main, unless it already does.
+
+    When main moved (a pull), the index is re-seeded from it and whatever an
+    unfinished push had hashed into it is gone: index rows still marked
+    pending lose their blob id, so those files get encrypted again.
+    """
+    main = git_output("rev-parse", "-q", "--verify", "refs/heads/main")
+    if SNAPSHOT_INDEX.exists() and git_output("rev-parse", "-q", "--verify", SNAPSHOT_REF) == main:
+        return
+    snapshot_git("read-tree", *([logical_tree(main)] if main else ["--empty"]))
+    if main:
+        snapshot_git("update-ref", SNAPSHOT_REF, main)
+    with closing(open_index()) as index, index:
+        index.execute("UPDATE files SET blob = NULL, pending = 0 WHERE pending")
+
+def snapshot_paths(*pathspecs):
+    """Paths in the private index matching pathspecs (taken literally; all of
+    encrypted/ by default), streamed in git's (byte-wise) order."""
+    env = dict(os.environ, GIT_INDEX_FILE=str(SNAPSHOT_INDEX))
+    proc = subprocess.Popen(["git", "--literal-pathspecs", "ls-files", "-z", "--",
+                             *(pathspecs or ["encrypted/"])],
+                            cwd=LOCAL_DIR, env=env, stdout=subprocess.PIPE)
+    rest = b""
+    try:
+        while chunk := proc.stdout.read(1 << 16):
+            *paths, rest = (rest + chunk).split(b"\0")
+            for path in paths:
+                yield os.fsdecode(path)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+def push_walk(mirror):
+    """One pass over everything push compares, as a stream of actions.
+
+    COURSES_DIR, the paths in the private index and (mirror storage) the
+    encrypted/ directory are scanned together, a directory at a time, in
+    git's path order, so each side is read once and nothing is held beyond
+    the directory being merged. Yields:
+
+      ("file", rel, entry, enc_entry)  a course file, with the DirEntry of
+                                       its .age file on disk if there is one
+      ("delete", path, tracked)        ciphertext whose course file is gone;
+                                       tracked if it is in the snapshot
+      ("rmdir", path)                  an encrypted/ directory with no course
+                                       files left under it, after its contents
+    """
+    tracked = snapshot_paths()
+    head = [next(tracked, None)]
+    try:
+        yield from _push_walk_dir("", COURSES_DIR, LOCAL_DIR / "encrypted" if mirror else None,
+                                  tracked, head)
+    finally:
+        tracked.close()
+
+JOURNAL_MAX_PATHS = 1000  # beyond this many journaled paths, walk the whole tree
+
+class PathEntry:
+    """The parts of os.DirEntry that push_walk's consumers use, for one path."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+def journal_walk(mirror, paths):
+    """push_walk over just the files and directories in paths."""
+    roots = sorted(set(paths))
+    if "" in roots or len(roots) > JOURNAL_MAX_PATHS:
+        yield from push_walk(mirror)
+        return
+    roots = [p for i, p in enumerate(roots) if not any(p.startswith(q + "/") for q in roots[:i])]
+    tracked = list(snapshot_paths(*(f"encrypted/{p}.age" for p in roots),
+                                  *(f"encrypted/{p}/" for p in roots)))
+    tracked_set = set(tracked)
+    courses, encrypted = str(COURSES_DIR), str(LOCAL_DIR / "encrypted")
+    for rel in roots:
+        course = os.path.join(courses, rel)
+        mirror_dir = os.path.join(encrypted, rel) if mirror else None
+        prefix = f"encrypted/{rel}/"
+        course_is_dir = os.path.isdir(course) and not os.path.islink(course)
+        subtree = [p for p in tracked if p.startswith(prefix)]
+        if course_is_dir or subtree or (mirror_dir and os.path.isdir(mirror_dir)):
+            walk = iter(subtree)
+            has_files = yield from _push_walk_dir(
+                rel + "/", course if course_is_dir else None,
+                mirror_dir if mirror_dir and os.path.isdir(mirror_dir) else None, walk, [next(walk, None)])
+            if not has_files and mirror_dir and os.path.isdir(mirror_dir):
+                yield "rmdir", mirror_dir
+
+        path = f"encrypted/{rel}.age"
+        enc = os.path.join(encrypted, rel + ".age") if mirror else None
+        if os.path.isfile(course) and not rel.endswith(TMP_SUFFIX):
+            yield "file", rel, PathEntry(course), PathEntry(enc) if enc and os.path.isfile(enc) else None
+        elif path in tracked_set or (enc and os.path.isfile(enc)):
+            yield "delete", path, path in tracked_set
+        # encrypted/ directories left without a course directory
+        parent = os.path.dirname(rel)
+        while mirror and parent and not os.path.isdir(os.path.join(courses, parent)):
+            yield "rmdir", os.path.join(encrypted, parent)
+            parent = os.path.dirname(parent)
+
+def _dir_keys(path, file_key):
+    """(key, entry) pairs of a directory sorted like git sorts tree entries:
+    subdirectories by name + "/", files by file_key(name) (None to skip)."""
+    keys = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    keys.append((entry.name + "/", entry))
+                elif (key := file_key(entry)) is not None:
+                    keys.append((key, entry))
+    except FileNotFoundError:
+        pass
+    keys.sort(key=lambda pair: pair[0])
+    return keys
+
+def _course_key(entry):
+    if entry.name.endswith(TMP_SUFFIX) or not entry.is_file():
+        return None  # a pull's temp file, or a special file
+    return entry.name + ".age"
+
+def _mirror_key(entry):
+    return entry.name if entry.name.endswith(".age") else None
+
+def _push_walk_dir(rel_dir, course_dir, mirror_dir, tracked, head):
+    """Merge one directory of the three sides; returns whether any course
+    file was found under it."""
+    prefix = "encrypted/" + rel_dir
+    courses = _dir_keys(course_dir, _course_key) if course_dir else []
+    mirrored = _dir_keys(mirror_dir, _mirror_key) if mirror_dir else []
+    ci = mi = 0
+    has_files = False
+    while True:
+        tracked_key = None
+        if head[0] is not None and head[0].startswith(prefix):
+            name, slash, _ = head[0][len(prefix):].partition("/")
+            tracked_key = name + slash
+        course = courses[ci] if ci < len(courses) else None
+        mirror = mirrored[mi] if mi < len(mirrored) else None
+        candidates = [k for k in (course and course[0], mirror and mirror[0], tracked_key) if k]
+        if not candidates:
+            return has_files
+        key = min(candidates)
+        course_entry = mirror_entry = None
+        if course and course[0] == key:
+            course_entry, ci = course[1], ci + 1
+        if mirror and mirror[0] == key:
+            mirror_entry, mi = mirror[1], mi + 1
+
+        if key.endswith("/"):
+            sub_has_files = yield from _push_walk_dir(
+                rel_dir + key, course_entry and course_entry.path,
+                mirror_entry and mirror_entry.path, tracked, head)
+            has_files |= sub_has_files
+            if mirror_entry and not sub_has_files:
+                yield "rmdir", mirror_entry.path
+            continue
+
+        is_tracked = tracked_key == key
+        if is_tracked:
+            head[0] = next(tracked, None)
+        if not key.endswith(".age"):
+            continue  # not ciphertext ClassGit wrote, leave it alone
+        if course_entry:
+            has_files = True
+            yield "file", rel_dir + course_entry.name, course_entry, mirror_entry
+        elif is_tracked or mirror_entry:
+            yield "delete", prefix + key, is_tracked
+
+def write_blob(fill):
+    """Id of a blob written by fill(pipe) into `git hash-object -w --stdin`."""
+    proc = subprocess.Popen(["git", "hash-object", "-w", "--no-filters", "--stdin"],
+                            cwd=LOCAL_DIR, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        fill(proc.stdin)
+    finally:
+        proc.stdin.close()
+    blob = proc.stdout.read().decode().strip()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, "git hash-object")
+    return blob
+
+STREAM_MIN = 16 << 20  # bigger blobs are streamed through blob_stream, not read whole
+
+@contextmanager
+def blob_stream(blob):
+    """A blob's contents as a pipe from its own `git cat-file blob`, for
+    blobs too big to hold in memory."""
+    proc = subprocess.Popen(["git", "cat-file", "blob", blob], cwd=LOCAL_DIR,
+                            stdout=subprocess.PIPE)
+    try:
+        yield proc.stdout
+    except BaseException:
+        proc.stdout.close()
+        proc.wait()
+        raise
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, "git cat-file blob")
+
+class BlobReader:
+    """Blobs from one long-lived `git cat-file --batch`, shared by worker threads.
+
+    Each blob is read whole while holding the lock and handed over as bytes,
+    so decryption runs in parallel while the reader moves on to the next one.
+    """
+
+    def __init__(self):
+        self.proc = subprocess.Popen(["git", "cat-file", "--batch"], cwd=LOCAL_DIR,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+
+    def read(self, blob):
+        with self.lock:
+            self.proc.stdin.write(f"{blob}\n".encode())
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().split()
+            if len(header) != 3:
+                raise KeyError(f"object {blob} is missing from the repository")
+            data = self.proc.stdout.read(int(header[2]))
+            self.proc.stdout.read(1)  # newline after the contents
+        return data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def blob_sizes(blobs):
+    """Sizes of blobs by id, from a single `git cat-file --batch-check`."""
+    if not blobs:
+        return {}
+    listing = subprocess.run(["git", "cat-file", "--batch-check"], cwd=LOCAL_DIR, check=True,
+                             input="".join(f"{blob}\n" for blob in blobs),
+                             capture_output=True, text=True).stdout
+    return {line.split()[0]: int(line.split()[2])
+            for line in listing.splitlines() if len(line.split()) == 3}
+
+def write_snapshot_tree(updates, removals, blobs=None):
+    """Tree of the private index with updates applied and removals dropped.
+
+    updates are files in LOCAL_DIR to hash into the object store, blobs maps
+    more paths to objects that are already there; all paths are relative to
+    LOCAL_DIR. Returns the tree id and the blob id of every updated path.
+    """
+    blobs = dict(blobs or {})
+    if updates:
+        ids = snapshot_git("hash-object", "-w", "--no-filters", "--stdin-paths",
+                           input="".join(f"{path}\n" for path in updates)).split()
+        blobs.update(zip(updates, ids))
+    info = [f"100644 {blob}\t{path}\0" for path, blob in blobs.items()]
+    info += [f"0 {'0' * 40}\t{path}\0" for path in removals]
+    if info:
+        snapshot_git("update-index", "-z", "--index-info", input="".join(info))
+    return snapshot_git("write-tree").strip(), blobs
+
+def commit_snapshot(tree, backend):
+    """Point main at a new commit of tree (converted to the content layout
+    if that is configured) and return it.
+
+    Its parent is the last synced snapshot, which other devices have too:
+    their fetch then only downloads the objects that changed. Every
+    SNAPSHOT_HISTORY snapshots the commit is parentless instead, which drops
+    old ciphertext from the remote's history (and, after maintenance, from
+    .git) at the cost of one full download on the other devices.
+    """
+    if layout() == "content":
+        tree = content_tree(tree, backend)
+    parent = git_output("rev-parse", "-q", "--verify", SYNCED_REF + "^{commit}")
+    if parent and int(git_output("rev-list", "--count", parent)) >= SNAPSHOT_HISTORY:
+        parent = None
+    commit = snapshot_git("commit-tree", tree, *(["-p", parent] if parent else []),
+                          "-m", SNAPSHOT_MESSAGE).strip()
+    snapshot_git("update-ref", "refs/heads/main", commit)
+    snapshot_git("update-ref", SNAPSHOT_REF, commit)
+    return commit
+
+# -----------------------------
+# Chunked storage
+# -----------------------------
+# With config/chunk_threshold.txt (in MiB; chunking is off without it),
+# files at least that big are cut at content-defined points into chunks
+# that are encrypted one by one and stored under chunks/, named by a hash
+# keyed with the age identity so that names reveal nothing about contents.
+# encrypted/<path>.age then holds an encrypted manifest listing the chunks.
+# An edit only changes the chunks around it: every other chunk keeps its
+# name and blob, and is neither encrypted nor pushed again.
+#
+# With config/part_size.txt (in MiB), files bigger than that that aren't
+# chunked are cut into parts of exactly that size instead, stored the same
+# way, which keeps every object under a host's file size limit. Chunks
+# and parts of one file are encrypted and decrypted in parallel.
+FRAME_PREFIX = b"CLASSGIT-"  # starts every payload header ClassGit writes
+CHUNK_MAGIC = b"CLASSGIT-CHUNKS v1\n"  # first line of a manifest's plaintext
+CHUNK_MIN = 256 << 10
+CHUNK_MAX = 4 << 20
+CHUNK_ANCHOR = re.compile(rb"[\n\0]")  # possible cut points: line ends and zero bytes
+CHUNK_WINDOW = 32  # bytes up to an anchor that decide whether to cut there,
+CHUNK_MASK = (1 << 13) - 1  # ... which about one anchor in 8192 does
+
+def chunk_threshold():
+    """Size from which files are stored in chunks, or None if chunking is off."""
+    mib = read_setting("chunk_threshold", None)
+    return int(float(mib) * (1 << 20)) if mib else None
+
+def part_size():
+    """Size of the parts large files are split into, or None if they aren't."""
+    mib = read_setting("part_size", None)
+    return int(float(mib) * (1 << 20)) if mib else None
+
+def frame_header(path):
+    """The first line of path if it is a ClassGit payload header, else None.
+
+    Course files that start like one are always stored in chunks (whose
+    payloads get a header of their own when they need one, see frame_raw),
+    so a decrypted header is never mistaken for file contents.
+    """
+    with open(path, "rb") as f:
+        head = f.readline(256)
+    return head if head.startswith(FRAME_PREFIX) else None
+
+def chunk_path(name):
+    return f"chunks/{name[:2]}/{name}.age"
+
+def find_cut(data):
+    """Length of the first chunk of data (CDC: cut where the bytes say so)."""
+    limit = min(len(data), CHUNK_MAX)
+    for anchor in CHUNK_ANCHOR.finditer(data, CHUNK_MIN, limit):
+        end = anchor.end()
+        if not zlib.crc32(data[end - CHUNK_WINDOW:end]) & CHUNK_MASK:
+            return end
+    return limit
+
+def split_chunks(f):
+    """Content-defined chunks of a binary file, as bytes. Inserting or
+    removing bytes only moves the cuts next to the edit."""
+    data = b""
+    while True:
+        block = f.read(CHUNK_MAX)
+        data += block
+        while len(data) >= CHUNK_MAX or (data and not block):
+            cut = find_cut(data)
+            yield data[:cut]
+            data = data[cut:]
+        if not block:
+            return
+
+def chunk_spans(path):
+    """(offset, size) of each content-defined chunk of a file."""
+    offset = 0
+    with open(path, "rb") as f:
+        for data in split_chunks(f):
+            yield offset, len(data)
+            offset += len(data)
+
+def chunk_key():
+    """Key for chunk names, from the age identity that every device shares."""
+    if not AGE_KEY_PATH.exists():
+        raise ClassGitError(f"storing files in chunks needs the age key in {AGE_KEY_PATH}")
+    secret = "".join(line.strip() for line in AGE_KEY_PATH.read_text().splitlines()
+                     if line.strip() and not line.startswith("#"))
+    return hashlib.blake2b(secret.encode(), digest_size=32, person=b"classgit-chunks").digest()
+
+class ChunkStore:
+    """The chunks in the private index, and those a push adds to it.
+
+    Shared by the encrypt workers: a chunk already in the snapshot, or
+    written by another worker, is reused instead of encrypted again. Each
+    file's chunks are spread over a pool of their own, but only JOBS chunks
+    are held in memory at a time, however many files are being chunked.
+    """
+
+    def __init__(self, backend, compressor):
+        self.backend = backend
+        self.compressor = compressor
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(JOBS)
+        self.key = None
+        self.blobs = None  # tree path -> blob, read from the private index on first use
+        self.added = {}  # tree path -> blob written by this push
+
+    def load(self):
+        with self.lock:
+            if self.blobs is None:
+                self.key = chunk_key()
+                listing = snapshot_git("ls-files", "-s", "-z", "--", "chunks/")
+                # "<mode> <blob> <stage>\t<path>"
+                self.blobs = {entry.split("\t", 1)[1]: entry.split()[1]
+                              for entry in listing.split("\0")[:-1]}
+
+    def store(self, src, rel, digest, part_size=None):
+        """Encrypt the chunks of src that aren't stored yet, content-defined
+        or parts of part_size bytes; returns the plaintext of its manifest
+        and the names of its chunks."""
+        self.load()
+        if part_size:
+            size = os.stat(src).st_size
+            spans = ((offset, min(part_size, size - offset)) for offset in range(0, size, part_size))
+        else:
+            spans = chunk_spans(src)
+        chunks = []
+        with open(src, "rb") as f:
+            for (_, size), name, error in run_parallel(
+                    lambda span: self.store_span(f.fileno(), rel, *span), spans):
+                if error:
+                    raise error
+                chunks.append([name, size])
+        manifest = {"size": sum(size for _, size in chunks), "hash": digest, "chunks": chunks}
+        return CHUNK_MAGIC + json.dumps(manifest).encode(), " ".join(n for n, _ in chunks)
+
+    def store_span(self, fd, rel, offset, size):
+        with self.slots:
+            data = os.pread(fd, size, offset)
+            if len(data) != size:
+                raise ValueError(f"{rel} changed while it was being stored")
+            name = hashlib.blake2b(data, digest_size=20, key=self.key).hexdigest()
+            path = chunk_path(name)
+            with self.lock:
+                known = path in self.blobs or path in self.added
+            if not known:
+                payload = self.compressor.pack(rel, data)
+                blob = write_blob(lambda pipe: self.backend.encrypt_data_to(payload, pipe))
+                with self.lock:
+                    self.added[path] = blob
+        return name
+
+def tree_blobs(commit, directory):
+    """Blob of every file under directory in commit, by tree path."""
+    listing = git_output("ls-tree", "-r", "-z", commit, "--", directory) or ""
+    # "<mode> blob <blob>\t<path>"
+    return {entry.split("\t", 1)[1]: entry.split()[2] for entry in listing.split("\0")[:-1]}
+
+def assemble_chunks(path, reader, backend, blobs, dictionaries, slots):
+    """Replace the decrypted manifest at path by the file it lists; returns
+    the chunk names and the ciphertext bytes read.
+
+    Chunks are decrypted in parallel, each written at its own offset, with
+    at most as many chunks in memory as slots allows.
+    """
+    manifest = json.loads(Path(path).read_bytes()[len(CHUNK_MAGIC):])
+    spans, offset = [], 0
+    for name, size in manifest["chunks"]:
+        spans.append((name, offset, size))
+        offset += size
+
+    def fetch(span):
+        name, offset, size = span
+        blob = blobs.get(chunk_path(name))
+        if blob is None:
+            raise KeyError(f"chunk {name} is missing from the snapshot")
+        with slots:
+            data = reader.read(blob)
+            plain = unpack(backend.decrypt_data(data), dictionaries)
+            if len(plain) != size:
+                raise ValueError(f"chunk {name} has {len(plain)} bytes, expected {size}")
+            os.pwrite(out.fileno(), plain, offset)
+        return len(data)
+
+    read = 0
+    with open(path, "wb") as out:
+        out.truncate(offset)
+        for _, length, error in run_parallel(fetch, spans):
+            if error:
+                raise error
+            read += length
+    if hash_file(path) != manifest["hash"]:
+        raise ValueError("reassembled file does not match its manifest")
+    return " ".join(name for name, _ in manifest["chunks"]), read
+
+def unreferenced_chunks():
+    """Chunks in the private index that no indexed file is made of any more."""
+    with closing(open_index()) as index:
+        referenced = {name for (names,) in index.execute(
+            "SELECT chunks FROM files WHERE chunks IS NOT NULL") for name in names.split()}
+    return [path for path in snapshot_paths("chunks/")
+            if os.path.basename(path)[:-len(".age")] not in referenced]
+
+# -----------------------------
+# Compression
+# -----------------------------
+# Ciphertext doesn't compress, so with config/compression.txt set to zstd
+# (needs the zstandard package) or zlib, files and chunks are compressed
+# before they are encrypted. Types that are compressed already are left
+# alone, and so is anything that doesn't shrink. A compressed payload starts
+# with a PACKED_MAGIC line naming its codec and dictionary. With zstd, a
+# file type with many small files gets a dictionary, trained on the files
+# of the first push that has enough of them and stored encrypted under
+# dicts/; small files of that type use it from then on.
+PACKED_MAGIC = b"CLASSGIT-PACKED v1 "  # + "<codec> <dictionary or ->\n"
+COMPRESS_SKIP = frozenset(
+    ".pdf .jpg .jpeg .png .gif .webp .heic .mp3 .m4a .ogg .opus .flac .mp4 .m4v .mkv "
+    ".mov .webm .avi .zip .gz .tgz .bz2 .xz .zst .7z .rar .jar .apk .epub .docx .xlsx "
+    ".pptx .odt .ods .odp .age".split())
+COMPRESS_MIN = 64  # bytes; smaller files aren't worth a header
+COMPRESS_MAX = 64 << 20  # larger files are compressed chunk by chunk, if at all
+COMPRESS_MIN_GAIN = 0.95  # keep the compressed form only if it is at most this big
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+DICT_FILE_MAX = 16 << 10  # files up to this size use (and train) dictionaries
+DICT_MIN_SAMPLES = 64
+DICT_MAX_SAMPLES = 2000
+DICT_SIZE = 64 << 10
+
+def load_zstandard():
+    """The zstandard module, or None if it isn't installed."""
+    global zstandard
+    if zstandard is None:
+        try:
+            import zstandard as module
+        except ImportError:
+            return None
+        zstandard = module
+    return zstandard
+
+def compression_codec():
+    """Codec from config/compression.txt: "zstd", "zlib" or None (off)."""
+    codec = read_setting("compression", "off")
+    if codec not in ("off", "zlib", "zstd"):
+        raise ValueError(f"Unknown compression {codec!r} in config/compression.txt, "
+                         "expected off, zlib or zstd")
+    if codec == "zstd" and load_zstandard() is None:
+        raise ClassGitError("config/compression.txt asks for zstd, but the zstandard "
+                            "package is not installed (pip install zstandard)")
+    return None if codec == "off" else codec
+
+def file_type(rel):
+    return os.path.splitext(rel)[1].lower() or "(none)"
+
+def frame_raw(data):
+    """data as a payload: unchanged, unless it could be taken for a header."""
+    return PACKED_MAGIC + b"raw -\n" + data if data.startswith(FRAME_PREFIX) else data
+
+def unpack(data, dictionaries):
+    """Plaintext of a decrypted payload; dictionaries(name) gives zstd's."""
+    if not data.startswith(PACKED_MAGIC):
+        return data
+    header, body = data.split(b"\n", 1)
+    codec, dictionary = header[len(PACKED_MAGIC):].decode().split()
+    if codec == "raw":
+        return body
+    if codec == "zlib":
+        return zlib.decompress(body)
+    if codec == "zstd":
+        if load_zstandard() is None:
+            raise ClassGitError("these courses are compressed with zstd, "
+                                "install the zstandard package (pip install zstandard)")
+        dict_data = dictionaries(dictionary) if dictionary != "-" else None
+        return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(body)
+    raise ValueError(f"unknown compression codec {codec!r}")
+
+class Compressor:
+    """Compresses what a push encrypts, keeping statistics per file type.
+
+    Shared by the encrypt workers like ChunkStore; zstd compressors aren't
+    thread-safe, so each worker thread gets its own.
+    """
+
+    def __init__(self, backend, codec):
+        self.backend = backend
+        self.codec = codec
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.key = None
+        self.stored = None  # dictionary tree path -> blob, read on first use
+        self.dicts = {}  # file type -> (name, ZstdCompressionDict) or None
+        self.samples = {}  # file type -> small files compressed without a dictionary
+        self.stats = {}  # file type -> [files, bytes, compressed bytes, seconds]
+
+    def wants(self, rel, size):
+        """True if a file of this type and size is worth compressing whole."""
+        return (self.codec is not None and COMPRESS_MIN <= size <= COMPRESS_MAX
+                and file_type(rel) not in COMPRESS_SKIP)
+
+    def dictionary_path(self, kind):
+        name = hashlib.blake2b(kind.encode(), digest_size=16, key=self.key,
+                               person=b"classgit-dict").hexdigest()
+        return name, f"dicts/{name}.age"
+
+    def dictionary(self, kind):
+        """(name, dictionary) for a file type, or None if it has none yet."""
+        with self.lock:
+            if self.stored is None:
+                self.key = chunk_key()
+                listing = snapshot_git("ls-files", "-s", "-z", "--", "dicts/")
+                self.stored = {entry.split("\t", 1)[1]: entry.split()[1]
+                               for entry in listing.split("\0")[:-1]}
+            if kind not in self.dicts:
+                name, path = self.dictionary_path(kind)
+                blob = self.stored.get(path)
+                if blob is None:
+                    self.dicts[kind] = None
+                else:
+                    data = subprocess.run(["git", "cat-file", "blob", blob], cwd=LOCAL_DIR,
+                                          capture_output=True, check=True).stdout
+                    self.dicts[kind] = name, zstandard.ZstdCompressionDict(
+                        self.backend.decrypt_data(data))
+            return self.dicts[kind]
+
+    def compress(self, data, dictionary):
+        if self.codec == "zlib":
+            return zlib.compress(data, ZLIB_LEVEL)
+        compressors = getattr(self.local, "compressors", None)
+        if compressors is None:
+            compressors = self.local.compressors = {}
+        name = dictionary[0] if dictionary else None
+        if name not in compressors:
+            compressors[name] = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL, dict_data=dictionary[1] if dictionary else None)
+        return compressors[name].compress(data)
+
+    def pack(self, rel, data, kind=None):
+        """The payload to encrypt for data, a file or chunk of rel."""
+        kind = kind or file_type(rel)
+        if self.codec is None or kind in COMPRESS_SKIP or len(data) < COMPRESS_MIN:
+            return frame_raw(data)
+        start = time.perf_counter()
+        small = self.codec == "zstd" and len(data) <= DICT_FILE_MAX
+        dictionary = self.dictionary(kind) if small else None
+        body = self.compress(data, dictionary)
+        seconds = time.perf_counter() - start
+        if len(body) > len(data) * COMPRESS_MIN_GAIN:
+            payload = frame_raw(data)
+        else:
+            header = f"{self.codec} {dictionary[0] if dictionary else '-'}\n"
+            payload = PACKED_MAGIC + header.encode() + body
+        with self.lock:
+            stats = self.stats.setdefault(kind, [0, 0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += len(data)
+            stats[2] += len(payload)
+            stats[3] += seconds
+            if small and dictionary is None:
+                samples = self.samples.setdefault(kind, [])
+                if len(samples) < DICT_MAX_SAMPLES:
+                    samples.append(data)
+        return payload
+
+    def train(self):
+        """Store a dictionary for each file type that had enough small files
+        without one; returns {tree path: blob} to add to the snapshot."""
+        added = {}
+        for kind, samples in self.samples.items():
+            if len(samples) < DICT_MIN_SAMPLES or self.dicts.get(kind) is not None:
+                continue
+            try:
+                trained = zstandard.train_dictionary(DICT_SIZE, samples).as_bytes()
+            except zstandard.ZstdError:
+                continue  # too little data to learn from
+            _, path = self.dictionary_path(kind)
+            added[path] = write_blob(lambda pipe: self.backend.encrypt_data_to(trained, pipe))
+            print(f"📚 Trained a compression dictionary for {kind} files "
+                  f"({len(samples)} samples), used from the next change on")
+        return added
+
+    def summary(self):
+        return {kind: {"files": files, "bytes": size, "compressed": packed,
+                       "seconds": round(seconds, 6)}
+                for kind, (files, size, packed, seconds) in sorted(self.stats.items())}
+
+class Dictionaries:
+    """The zstd dictionaries of a snapshot being pulled, decrypted on first use."""
+
+    def __init__(self, reader, backend, blobs):
+        self.reader = reader
+        self.backend = backend
+        self.blobs = blobs
+        self.lock = threading.Lock()
+        self.loaded = {}
+
+    def __call__(self, name):
+        with self.lock:
+            if name not in self.loaded:
+                blob = self.blobs.get(f"dicts/{name}.age")
+                if blob is None:
+                    raise KeyError(f"compression dictionary {name} is missing from the snapshot")
+                self.loaded[name] = zstandard.ZstdCompressionDict(
+                    self.backend.decrypt_data(self.reader.read(blob)))
+            return self.loaded[name]
+
+def print_compression(summary):
+    for kind, stats in summary.items():
+        ratio = stats["bytes"] / stats["compressed"] if stats["compressed"] else 0
+        print(f"🗜️ {kind}: {stats['files']} file(s), {stats['bytes'] / 1024:.0f} → "
+              f"{stats['compressed'] / 1024:.0f} KiB ({ratio:.1f}×) in {stats['seconds']:.2f} s")
+
+# -----------------------------
+# Bundles
+# -----------------------------
+# With config/bundle_threshold.txt (in KiB; off without it), course files
+# smaller than that aren't stored one by one: the small files of each
+# directory travel together in one encrypted bundle, bundles/<name>.age,
+# named by a hash of the directory keyed like chunk names. A bundle starts
+# with an index of its files, followed by their contents back to back. A
+# change to a small file rewrites its directory's bundle and nothing else.
+BUNDLE_MAGIC = b"CLASSGIT-BUNDLE v1\n"
+
+def bundle_threshold():
+    kib = read_setting("bundle_threshold", None)
+    return int(float(kib) * 1024) if kib else None
+
+def bundle_path(directory, key):
+    name = hashlib.blake2b(directory.encode(), digest_size=16, key=key,
+                           person=b"classgit-bundle").hexdigest()
+    return f"bundles/{name}.age"
+
+def pack_bundle(directory, members):
+    """Plaintext of a bundle of (name, data, digest) members."""
+    index = {"dir": directory,
+             "files": [[name, len(data), digest] for name, data, digest in members]}
+    return (BUNDLE_MAGIC + json.dumps(index).encode() + b"\n"
+            + b"".join(data for _, data, _ in members))
+
+def read_bundle(plaintext):
+    """(directory, [(name, data, digest)]) from a bundle's plaintext."""
+    if not plaintext.startswith(BUNDLE_MAGIC):
+        raise ValueError("not a ClassGit bundle")
+    header, _, body = plaintext[len(BUNDLE_MAGIC):].partition(b"\n")
+    index = json.loads(header)
+    members, offset = [], 0
+    for name, size, digest in index["files"]:
+        members.append((name, body[offset:offset + size], digest))
+        offset += size
+    return index["dir"], members
+
+def open_bundles(bundles, backend, commit):
+    """Decrypt the bundles [(path, blob)] of commit in parallel; returns
+    [((path, blob), (directory, members, ciphertext size), error)]."""
+    with BlobReader() as reader:
+        dictionaries = Dictionaries(reader, backend, tree_blobs(commit, "dicts/"))
+
+        def open_bundle(task):
+            path, blob = task
+            data = reader.read(blob)
+            with timed_file("decrypt", path, len(data)):
+                directory, members = read_bundle(unpack(backend.decrypt_data(data), dictionaries))
+            return directory, members, len(data)
+        return list(run_parallel(open_bundle, bundles))
+
+def bundled_files(opened):
+    """{path: digest} of the files in bundles that open_bundles could read."""
+    files = {}
+    for _, result, error in opened:
+        if not error:
+            directory, members, _ = result
+            files.update((f"{directory}/{name}" if directory else name, digest)
+                         for name, _, digest in members)
+    return files
+
+class Bundler:
+    """Works out during a push which bundles have to be rewritten, and
+    rewrites them once the walk is over."""
+
+    def __init__(self, backend, compressor, index):
+        self.backend = backend
+        self.compressor = compressor
+        self.threshold = bundle_threshold() or 0
+        # with bundling turned off, files in older bundles go back to being stored alone
+        self.active = bool(self.threshold) or index.execute(
+            "SELECT 1 FROM files WHERE bundle IS NOT NULL LIMIT 1").fetchone() is not None
+        self.lock = threading.Lock()
+        self.key = None
+        self.seen = set()  # course files the walk came across
+        self.changed = set()  # small files whose content changed
+        self.left = set()  # files that outgrew their bundle
+        self.dirty = set()  # directories whose bundle must be rewritten
+
+    def wants(self, size):
+        return size < self.threshold
+
+    def gone(self, index, paths):
+        """Bundled files that the walk (of paths, see journal_walk) no longer found."""
+        everything = paths is None or "" in paths or len(set(paths)) > JOURNAL_MAX_PATHS
+        gone = []
+        for row in index.execute("SELECT path, bundle FROM files WHERE bundle IS NOT NULL"):
+            rel = row["path"]
+            if rel not in self.seen and (everything or any(
+                    rel == p or rel.startswith(p + "/") for p in paths)):
+                gone.append(rel)
+                self.dirty.add(row["bundle"])
+        return gone
+
+    def tasks(self, index, gone):
+        """(directory, files) of every bundle to rewrite."""
+        members = {directory: set() for directory in self.dirty}
+        for rel in self.changed:
+            members[os.path.dirname(rel)].add(rel)
+        gone = set(gone)
+        for directory in self.dirty:
+            for (rel,) in index.execute("SELECT path FROM files WHERE bundle = ?", (directory,)):
+                if rel not in gone and rel not in self.left:
+                    members[directory].add(rel)
+        return [(directory, sorted(rels)) for directory, rels in sorted(members.items())]
+
+    def write(self, task):
+        """Encrypt one directory's bundle; returns its tree path, its blob
+        (None if no file is left for it), (rel, stat, digest) of its files
+        and the files that disappeared meanwhile."""
+        directory, rels = task
+        with self.lock:
+            if self.key is None:
+                self.key = chunk_key()
+        path = bundle_path(directory, self.key)
+        members, entries, missing = [], [], []
+        for rel in rels:
+            src = COURSES_DIR / rel
+            try:
+                st = os.stat(src)  # before reading: a later write moves the stat again
+                data = src.read_bytes()
+            except FileNotFoundError:
+                missing.append(rel)
+                continue
+            digest = hashlib.blake2b(data, digest_size=32).hexdigest()
+            members.append((os.path.basename(rel), data, digest))
+            entries.append((rel, st, digest))
+        if not members:
+            return path, None, [], missing
+        payload = self.compressor.pack(path, pack_bundle(directory, members), kind="(bundle)")
+        blob = write_blob(lambda pipe: self.backend.encrypt_data_to(payload, pipe))
+        return path, blob, entries, missing
+
+# -----------------------------
+# Content-addressed layout
+# -----------------------------
+# Identical course files share their ciphertext: a file whose content
+# already has some (at another path, from this push or an earlier one)
+# reuses it instead of being encrypted and stored again. With
+# config/layout.txt set to "content", the pushed tree names no course file
+# at all: each distinct content is stored once as objects/<name>.age, named
+# by a hash of its plaintext keyed like chunk names, and an encrypted
+# manifest.age maps paths to names. Locally nothing changes: the private
+# index keeps the path layout, which is converted when a snapshot is
+# committed and rebuilt from the manifest when one is pulled.
+#
+# A file moved or renamed within courses/ is the same case: its new path
+# reuses the ciphertext of the old one, which it is recognized by without
+# hashing it again (a rename keeps the inode, size and mtime), so
+# reorganizing courses/ only commits a new tree.
+MANIFEST_PATH = "manifest.age"
+
+def layout():
+    name = read_setting("layout", "paths")
+    if name not in ("paths", "content"):
+        raise ValueError(f"Unknown layout {name!r} in config/layout.txt, expected paths or content")
+    return name
+
+class Duplicates:
+    """Ciphertext already made for a content, shared by the encrypt workers.
+
+    find() returns (blob, mirror file, chunks) for a digest, either from an
+    indexed file or from a worker that encrypted it during this push, or
+    None: then the caller encrypts it and reports back with made(), while
+    workers asking for the same digest wait. The mirror file is None when
+    find() already moved it into place; moved maps each path that took over
+    the ciphertext of a course file that is gone to that file's path.
+    """
+
+    def __init__(self, mirror):
+        self.mirror = mirror
+        self.lock = threading.Lock()
+        self.db = None
+        self.waiting = {}  # digest -> Event set once it is encrypted
+        self.results = {}  # digest -> (blob, mirror file, chunks) made or moved this push
+        self.moved = {}
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(INDEX_PATH, check_same_thread=False)
+            self.db.row_factory = sqlite3.Row
+        return self.db
+
+    def digest_of(self, st):
+        """Hash of the indexed file that st is the unchanged inode of, if any."""
+        if not st.st_mtime_ns:
+            return None
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT hash FROM files WHERE ino = ? AND size = ? AND mtime_ns = ?",
+                (st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+        return row and row[0]
+
+    def hash(self, rel, path, st, row):
+        """Hash of a course file (index row, None if it isn't indexed): looked
+        up for a moved inode, else read."""
+        digest = self.digest_of(st) if row is None else None
+        if digest is None:
+            with timed_file("hash", rel, st.st_size):
+                digest = hash_file(path)
+        return digest
+
+    def sources(self, digest, rel):
+        """(course file stat or None if it is gone, row) of the indexed files
+        whose ciphertext rel could reuse, the ones that are gone first."""
+        rows = self.connect().execute(
+            "SELECT * FROM files WHERE hash = ? AND blob IS NOT NULL AND bundle IS NULL "
+            "AND path != ?", (digest, rel)).fetchall()
+        return sorted(((stat_or_none(COURSES_DIR / row["path"]), row) for row in rows),
+                      key=lambda source: source[0] is not None)
+
+    def find(self, digest, rel, dst):
+        with self.lock:
+            if digest in self.results:
+                return self.results[digest]
+            event = self.waiting.get(digest)
+            if event is None:
+                found = self.indexed(digest, rel, dst)
+                if found is not None:
+                    return found
+                self.waiting[digest] = threading.Event()
+                return None
+        event.wait()
+        return self.results.get(digest)
+
+    def indexed(self, digest, rel, dst):
+        for st, row in self.sources(digest, rel):
+            enc = None
+            if self.mirror:
+                enc = LOCAL_DIR / "encrypted" / (row["path"] + ".age")
+                # its .age file is rewritten by this push if the file changed
+                if not (enc_matches(row, stat_or_none(enc)) and (st is None or stat_matches(row, st))):
+                    continue
+            if st is None:  # later copies of it copy this path's instead
+                self.moved[rel] = row["path"]
+                if enc is not None:
+                    dst.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(enc, dst)
+                self.results[digest] = row["blob"], enc and dst, row["chunks"]
+                return row["blob"], None, row["chunks"]
+            return row["blob"], enc, row["chunks"]
+        return None
+
+    def made(self, digest, blob, enc, chunks):
+        """Report the outcome of a find() that returned None (blob None on failure)."""
+        with self.lock:
+            if blob is not None or enc is not None:
+                self.results[digest] = blob, enc, chunks
+            self.waiting[digest].set()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+def layout_matches(commit):
+    """True if commit was pushed in the configured layout."""
+    has_manifest = git_output("rev-parse", "-q", "--verify", f"{commit}:{MANIFEST_PATH}") is not None
+    return has_manifest == (layout() == "content")
+
+def object_path(digest, key):
+    name = hashlib.blake2b(bytes.fromhex(digest), digest_size=20, key=key,
+                           person=b"classgit-object").hexdigest()
+    return f"objects/{name[:2]}/{name}.age"
+
+def build_tree(info):
+    """Tree of `update-index --index-info` entries, built in a throwaway index."""
+    fd, path = tempfile.mkstemp(dir=LOCAL_DIR / ".git", prefix="classgit-tree-")
+    os.close(fd)
+    os.unlink(path)  # git creates its own
+    env = dict(os.environ, GIT_INDEX_FILE=path)
+    try:
+        subprocess.run(["git", "update-index", "-z", "--index-info"], cwd=LOCAL_DIR, env=env,
+                       input="".join(info), text=True, capture_output=True, check=True)
+        return subprocess.run(["git", "write-tree"], cwd=LOCAL_DIR, env=env, text=True,
+                              capture_output=True, check=True).stdout.strip()
+    finally:
+        Path(path).unlink(missing_ok=True)
+
+def remember_layout(tree, logical):
+    with closing(open_index()) as index, index:
+        index.execute("INSERT OR REPLACE INTO layouts VALUES (?, ?)", (tree, logical))
+
+def content_tree(tree, backend):
+    """The content layout of a path layout tree."""
+    key = chunk_key()
+    files, info = {}, []
+    listing = git_output("ls-tree", "-r", "-z", tree) or ""
+    with closing(open_index()) as index:
+        for entry in listing.split("\0")[:-1]:
+            meta, path = entry.split("\t", 1)
+            mode, _, blob = meta.split()
+            if not (path.startswith("encrypted/") and path.endswith(".age")):
+                info.append(f"{mode} {blob}\t{path}\0")
+                continue
+            rel = path[len("encrypted/"):-len(".age")]
+            row = index_get(index, rel)
+            if row is not None and row["blob"] == blob:
+                obj = object_path(row["hash"], key)
+            else:  # not indexed, nothing to tell its content by
+                obj = f"objects/{blob[:2]}/{blob}.age"
+            files[rel] = obj
+            info.append(f"100644 {blob}\t{obj}\0")
+    manifest = PACKED_MAGIC + b"zlib -\n" + zlib.compress(json.dumps({"files": files}).encode())
+    blob = write_blob(lambda pipe: backend.encrypt_data_to(manifest, pipe))
+    info.append(f"100644 {blob}\t{MANIFEST_PATH}\0")
+    physical = build_tree(info)
+    remember_layout(physical, tree)
+    return physical
+
+def logical_tree(commit, backend=None):
+    """The path layout tree of commit, whichever layout it was pushed in."""
+    tree = git_output("rev-parse", "-q", "--verify", commit + "^{tree}")
+    if tree is None:
+        return None
+    manifest = git_output("rev-parse", "-q", "--verify", f"{tree}:{MANIFEST_PATH}")
+    if manifest is None:
+        return tree
+    with closing(open_index()) as index:
+        row = index.execute("SELECT logical FROM layouts WHERE tree = ?", (tree,)).fetchone()
+    if row is not None and git_output("cat-file", "-e", row[0]) is not None:
+        return row[0]
+    backend = backend or get_backend()
+    data = subprocess.run(["git", "cat-file", "blob", manifest], cwd=LOCAL_DIR,
+                          capture_output=True, check=True).stdout
+    files = json.loads(unpack(backend.decrypt_data(data), None))["files"]
+    info = []
+    listing = git_output("ls-tree", "-r", "-z", tree) or ""
+    objects = {}
+    for entry in listing.split("\0")[:-1]:
+        meta, path = entry.split("\t", 1)
+        mode, _, blob = meta.split()
+        if path.startswith("objects/"):
+            objects[path] = blob
+        elif path != MANIFEST_PATH:
+            info.append(f"{mode} {blob}\t{path}\0")
+    info += [f"100644 {objects[obj]}\tencrypted/{rel}.age\0" for rel, obj in files.items()]
+    logical = build_tree(info)
+    remember_layout(tree, logical)
+    return logical
+
+# -----------------------------
+# Repository maintenance
+# -----------------------------
+# Every push and fetch adds loose objects or a pack, and a snapshot that
+# starts history over orphans the old ones, so the repository collects
+# packs and unreachable ciphertext to repack and prune now and then. git's
+# own auto-gc is off: after each push and pull a background process does
+# it when the policy below says so, never on their path. .age blobs are random bytes: git's delta search
+# and zlib can't shrink them, so they are marked -delta and packed with
+# the cheapest compression.
+MAINTENANCE_LOOSE_OBJECTS = 2000      # run once this many loose objects pile up
+MAINTENANCE_LOOSE_BYTES = 256 << 20   # ... or they take this much space
+MAINTENANCE_MAX_PACKS = 20            # ... or there are this many packs
+MAINTENANCE_INTERVAL = 7 * 24 * 3600  # ... or the last run is this old
+MAINTENANCE_PRUNE_EXPIRE = "1.hour.ago"  # spare objects a running push just wrote
+STALE_LOCK_SECONDS = 6 * 3600
+
+STORAGE_ATTRIBUTES = """# Written by ClassGit: ciphertext never deltas or compresses
+*.age -delta binary
+"""
+STORAGE_CONFIG = {
+    "core.bigFileThreshold": "1m",  # store large blobs whole, streamed
+    "pack.compression": "1",
+    "pack.window": "10",
+    "pack.windowMemory": "64m",
+    "gc.auto": "0",  # ClassGit schedules repacks itself
+}
+
+def apply_storage_policy():
+    """Write the encrypted-blob storage policy into .git, once."""
+    if write_if_changed(LOCAL_DIR / ".git" / "info" / "attributes", STORAGE_ATTRIBUTES):
+        for key, value in STORAGE_CONFIG.items():
+            subprocess.run(["git", "config", key, value], cwd=LOCAL_DIR, check=True)
+
+def repository_stats():
+    """count-objects -v as a dict of ints, sizes in bytes."""
+    stats = {}
+    for line in (git_output("count-objects", "-v") or "").splitlines():
+        key, _, value = line.partition(":")
+        if value.strip().isdigit():
+            stats[key] = int(value) * (1024 if key.startswith("size") else 1)
+    return stats
+
+def last_maintenance():
+    if not MAINTENANCE_LOG.exists():
+        return None
+    lines = MAINTENANCE_LOG.read_text().splitlines()
+    return json.loads(lines[-1]) if lines else None
+
+def maintenance_due(stats=None):
+    stats = stats if stats is not None else repository_stats()
+    if (stats.get("count", 0) >= MAINTENANCE_LOOSE_OBJECTS
+            or stats.get("size", 0) >= MAINTENANCE_LOOSE_BYTES
+            or stats.get("packs", 0) >= MAINTENANCE_MAX_PACKS):
+        return True
+    last = last_maintenance()
+    idle = stats.get("count", 0) == 0 and stats.get("packs", 0) <= 1
+    return not idle and (last is None or time.time() - last["started"] >= MAINTENANCE_INTERVAL)
+
+def schedule_maintenance():
+    """Start run_maintenance in a detached process if the policy says it's due."""
+    if MAINTENANCE_LOCK.exists() or not maintenance_due():
+        return
+    with open(CONFIG_DIR / "maintenance.out", "ab") as out:
+        subprocess.Popen([sys.executable, str(Path(__file__).resolve()), "maintenance",
+                          "--workspace", str(LOCAL_DIR)],
+                         cwd=LOCAL_DIR, stdin=subprocess.DEVNULL, stdout=out,
+                         stderr=subprocess.STDOUT, start_new_session=True)
+    print("🧰 Repository maintenance started in the background.")
+
+def acquire_lock(path):
+    try:
+        if time.time() - path.stat().st_mtime > STALE_LOCK_SECONDS:
+            path.unlink()  # left behind by a run that was killed
+    except FileNotFoundError:
+        pass
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        return False
+
+def run_maintenance():
+    """Expire reflogs, repack and prune, recording how long each step took."""
+    if not acquire_lock(MAINTENANCE_LOCK):
+        print("🧰 Maintenance is already running.")
+        return None
+    try:
+        apply_storage_policy()
+        record = {"started": time.time(), "before": repository_stats(), "steps": {}}
+        steps = [
+            ("reflog", ["git", "reflog", "expire", "--expire=now", "--all"]),
+            ("repack", ["git", "repack", "-a", "-d", "-q"]),
+            ("prune", ["git", "prune", f"--expire={MAINTENANCE_PRUNE_EXPIRE}"]),
+            ("pack-refs", ["git", "pack-refs", "--all"]),
+        ]
+        for name, cmd in steps:
+            start = time.perf_counter()
+            subprocess.run(cmd, cwd=LOCAL_DIR, check=True)
+            record["steps"][name] = round(time.perf_counter() - start, 3)
+        record["duration"] = round(sum(record["steps"].values()), 3)
+        record["after"] = repository_stats()
+        with open(MAINTENANCE_LOG, "a") as log:
+            log.write(json.dumps(record) + "\n")
+        print(f"🧰 Maintenance done in {record['duration']:.1f}s: "
+              f"{record['before'].get('count', 0)} loose objects packed, pack size "
+              f"{record['before'].get('size-pack', 0) >> 20} → {record['after'].get('size-pack', 0) >> 20} MiB")
+        return record
+    finally:
+        MAINTENANCE_LOCK.unlink(missing_ok=True)
 
 # -----------------------------
 # Setup Functions
@@ -118,6 +2045,11 @@ def configure_repo():
 
     return repo_url
 
+def is_set_up():
+    """True once configure_repo has run here, so commands need not prompt."""
+    return all(path.exists() for path in (AGE_KEY_PATH, REPO_FILE, PUBLIC_KEY_FILE,
+                                          LOCAL_DIR / ".git"))
+
 def get_public_key():
     return PUBLIC_KEY_FILE.read_text().strip()
 
@@ -125,7 +2057,7 @@ def get_public_key():
 # Core Functions
 # -----------------------------
 def generate_readme(tmpdir):
-    """Create or update README.md with system info."""
+    """Create or update README.md with system info; True if it changed."""
     readme_path = tmpdir / "README.md"
     content = f"""# ClassGit
 
@@ -143,166 +2075,1411 @@ ClassGit is a system for secure synchronization of your course files using Git a
 1. **Push courses:** Encrypts all files in `{COURSES_DIR}` and pushes them to the remote repo.
 2. **Pull courses:** Downloads encrypted files from GitHub and decrypts them automatically into `{COURSES_DIR}`.
 3. **Add a new device:** Copy your age key to another device to access the encrypted files.
-4. **Git status:** Check the repository status locally.
+4. **Sync status:** See which course files are not pushed, not pulled or changed on both sides.
 
 ## License & Disclaimer
 
 ClassGit is provided **as-is**. The author is not responsible for any data loss, misuse, or damage caused while using the system.
 """
-    readme_path.write_text(content)
+    return write_if_changed(readme_path, content)
 
-def push_courses(repo_url):
-    recipient = get_public_key()
-    if not any(COURSES_DIR.iterdir()):
-        print("No course files found to push.")
-        return
+GITIGNORE = """# Local sensitive / plaintext
+config/
+courses/
 
-    encrypted_dir = LOCAL_DIR / "encrypted"
-    encrypted_dir.mkdir(exist_ok=True)
+# Keep encrypted files (in encrypted/ or repo root) and README
+!.gitignore
+!README.md
+"""
+
+def indexed_as_is(row, st, bundled):
+    """True if a course file still has the stat and the storage (bundled or
+    not) it was indexed with: push and plan skip it without hashing."""
+    return stat_matches(row, st) and bool(row["blob"]) and bundled == (row["bundle"] is not None)
 
-    print("🔒 Synchronizing encrypted directory...")
+def push_action(rel, st, enc_st, row, digest, bundled):
+    """What a push does with a course file it hashed: "unchanged", "rehash"
+    (its ciphertext is current, only the blob id is missing), "bundle" (goes
+    into its directory's bundle) or None (it needs ciphertext: a duplicate's,
+    see Duplicates, or its own)."""
+    if bundled:
+        if (row is not None and row["hash"] == digest and row["blob"]
+                and row["bundle"] == os.path.dirname(rel)):
+            return "unchanged"
+        return "bundle"  # rewritten with its bundle after the walk
+    if row is not None and row["hash"] == digest and row["bundle"] is None:
+        if row["blob"]:
+            return "unchanged"
+        if enc_matches(row, enc_st):
+            return "rehash"  # indexed before blob ids were recorded
+    if row is None and enc_st is not None and enc_st.st_mtime_ns >= st.st_mtime_ns:
+        return "rehash"  # ciphertext from before the index existed
+    return None
+
+def encrypt_changes(backend, mirror, paths=None):
+    """Encrypt the course files that changed and find the ones that went.
+
+    paths limits the check to those files and directories (see
+    journal_walk); None compares the whole tree. Returns (updates,
+    removals, blobs, hashed), or None if some file could not be encrypted.
+    """
+    encrypted_dir = LOCAL_DIR / "encrypted"
+    updates, removals = [], []
+    blobs = {}  # tree path -> blob already written (objects storage, chunks, bundles)
+    # rel -> (tree path, stat, digest, chunks, bundle) waiting for a blob id,
+    # or None for a bundled file that went
+    hashed = {}
+    threshold, parts = chunk_threshold(), part_size()
+    compressor = Compressor(backend, compression_codec())
+    chunk_store = ChunkStore(backend, compressor)
+    duplicates = Duplicates(mirror)
+    # ciphertext whose course file is gone, and encrypted/ directories left
+    # empty, are only removed after the walk: a moved file may take them over
+    orphans, empty_dirs = [], []
 
     # --- Encrypt or update changed files ---
-    for root, dirs, files in os.walk(COURSES_DIR):
-        rel_path = Path(root).relative_to(COURSES_DIR)
-        for d in dirs:
-            (encrypted_dir / rel_path / d).mkdir(parents=True, exist_ok=True)
-        for f in files:
-            src = Path(root) / f
-            dst = encrypted_dir / rel_path / (f + ".age")
-            if not dst.exists() or src.stat().st_mtime > dst.stat().st_mtime:
-                print(f"🔒 Encrypting {src} → {dst}")
-                encrypt_file(src, recipient, dst)
-
-    # --- Remove orphan encrypted files ---
-    for root, dirs, files in os.walk(encrypted_dir):
-        for f in files:
-            if not f.endswith(".age"):
-                continue
-            enc_path = Path(root) / f
-            try:
-                rel = enc_path.relative_to(encrypted_dir)
-            except Exception:
-                continue
-            orig = COURSES_DIR / rel.with_suffix('')  # remove .age
-            if not orig.exists():
-                print(f"🗑️ Removing orphan encrypted file: {enc_path}")
+    def candidates():
+        walk = push_walk(mirror) if paths is None else journal_walk(mirror, paths)
+        for action, *args in walk:
+            if action == "file":
+                rel, entry, enc_entry = args
+                st = entry.stat()
+                row = index_get(index, rel)
+                if bundler.active:
+                    bundler.seen.add(rel)
+                bundled = bundler.wants(st.st_size)
+                if indexed_as_is(row, st, bundled):
+                    continue
+                enc_st = enc_entry.stat() if mirror and enc_entry else None
+                yield (rel, Path(entry.path), encrypted_dir / (rel + ".age"), st, enc_st, row,
+                       bundled)
+            elif action == "delete":
+                orphans.append(args)
+            elif action == "rmdir":
+                empty_dirs.append(args[0])
+
+    def remove_orphans():
+        moved = set(duplicates.moved.values())
+        for path, tracked in orphans:
+            rel = path[len("encrypted/"):-4]
+            if tracked:
+                removals.append(path)
+            if rel not in moved:
+                print(f"🗑️ Removing orphan encrypted file: {path}")
+                if tracked:
+                    RUN.deleted += 1
+                    report_progress("removed", rel)
+            if mirror:
                 try:
-                    enc_path.unlink()
+                    (LOCAL_DIR / path).unlink(missing_ok=True)
                 except Exception as e:
-                    print(f"❌ Failed to remove {enc_path}: {e}")
+                    print(f"❌ Failed to remove {LOCAL_DIR / path}: {e}")
+        for path in empty_dirs:
+            try:
+                os.rmdir(path)
+                print(f"🗑️ Removing empty directory: {path}")
+            except OSError:
+                pass  # holds files ClassGit didn't write
+
+    def encrypt_if_changed(task):
+        rel, src, dst, st, enc_st, row, bundled = task
+        digest = duplicates.hash(rel, src, st, row)
+        action = push_action(rel, st, enc_st, row, digest, bundled)
+        if action is not None:
+            return digest, action, None, row["chunks"] if row and action != "bundle" else None
+        found = duplicates.find(digest, rel, dst)
+        if found is not None:
+            blob, enc, chunks = found
+            if enc is not None:
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(enc, dst)
+            return digest, "moved" if rel in duplicates.moved else "copied", blob, chunks
+        made = None, None, None
+        try:
+            made = encrypt_file(rel, src, dst, st, digest)
+        finally:
+            duplicates.made(digest, *made)
+        return (digest, "encrypted", *made[::2])
+
+    def encrypt_file(rel, src, dst, st, digest):
+        """Encrypt src; returns (blob or None, mirror file or None, chunks)."""
+        with timed_file("encrypt", rel, st.st_size):
+            payload = chunks = None  # None: encrypt src as it is
+            if (threshold is not None and st.st_size >= threshold) or frame_header(src):
+                payload, chunks = chunk_store.store(src, rel, digest)
+            elif parts is not None and st.st_size > parts:
+                payload, chunks = chunk_store.store(src, rel, digest, parts)
+            elif compressor.wants(rel, st.st_size):
+                payload = compressor.pack(rel, Path(src).read_bytes())
+            if mirror:
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                if payload is None:
+                    backend.encrypt(src, dst)
+                else:
+                    with open(dst, "wb") as out:
+                        backend.encrypt_data_to(payload, out)
+                return None, dst, chunks
+            if payload is None:
+                return write_blob(lambda pipe: backend.encrypt_to(src, pipe)), None, chunks
+            return write_blob(lambda pipe: backend.encrypt_data_to(payload, pipe)), None, chunks
+
+    with stage("encrypt walk"):
+        failed = 0
+        with closing(open_index()) as index, index:
+            bundler = Bundler(backend, compressor, index)
+            for (rel, src, dst, st, enc_st, row, _), result, error in run_parallel(
+                    encrypt_if_changed, candidates(), size=lambda t: t[3].st_size):
+                if error:
+                    print(f"❌ Failed to encrypt {src}: {error}")
+                    failed += 1
+                    continue
+                digest, action, blob, chunks = result
+                if action == "unchanged":
+                    index_put(index, rel, st, digest, enc_st, row["blob"], row["pending"], chunks,
+                              row["bundle"])
+                    continue
+                path = f"encrypted/{rel}.age"
+                if action == "bundle":
+                    bundler.changed.add(rel)
+                    bundler.dirty.add(os.path.dirname(rel))
+                    if row is not None and row["bundle"] is None:
+                        removals.append(path)  # was stored on its own until now
+                        if mirror:
+                            dst.unlink(missing_ok=True)
+                    continue
+                if row is not None and row["bundle"] is not None:
+                    bundler.left.add(rel)
+                    bundler.dirty.add(row["bundle"])
+                if action == "encrypted":
+                    print(f"🔒 Encrypted {src} → {dst if mirror else path}")
+                    RUN.files += 1
+                    RUN.bytes += st.st_size
+                    report_progress("encrypted", rel, st.st_size)
+                elif action == "moved":
+                    print(f"🚚 Moved {COURSES_DIR / duplicates.moved[rel]} → {src}, "
+                          "reusing its ciphertext")
+                    report_progress("moved", rel)
+                elif action == "copied":
+                    print(f"🔗 {src} has the content of an encrypted file, reusing its ciphertext")
+                    RUN.files += 1
+                    report_progress("encrypted", rel, st.st_size)
+                if blob:
+                    blobs[path] = blob
+                else:
+                    updates.append(path)
+                hashed[rel] = path, st, digest, chunks, None
+            remove_orphans()
+
+            if bundler.active and not failed:
+                gone = bundler.gone(index, paths)
+                for rel in gone:
+                    print(f"🗑️ Removing {rel} from its bundle")
+                    hashed[rel] = None
+                    RUN.deleted += 1
+                    report_progress("removed", rel)
+                for (directory, _), result, error in run_parallel(
+                        bundler.write, bundler.tasks(index, gone), size=lambda t: len(t[1])):
+                    if error:
+                        print(f"❌ Failed to bundle {COURSES_DIR / directory}: {error}")
+                        failed += 1
+                        continue
+                    path, blob, entries, missing = result
+                    for rel in missing:
+                        hashed[rel] = None
+                    if blob is None:
+                        removals.append(path)
+                        continue
+                    blobs[path] = blob
+                    for rel, st, digest in entries:
+                        hashed[rel] = path, st, digest, None, directory
+                        if rel in bundler.changed:
+                            RUN.files += 1
+                            RUN.bytes += st.st_size
+                            report_progress("encrypted", rel, st.st_size)
+                    print(f"📦 Bundled {len(entries)} file(s) of {COURSES_DIR / directory}")
+        duplicates.close()
+        blobs.update(chunk_store.added)
+        RUN.compression = compressor.summary()
+        print_compression(RUN.compression)
+        if not failed and compressor.codec == "zstd":
+            blobs.update(compressor.train())
+    if failed:
+        RUN.failures = failed
+        RUN.fail(f"{failed} file(s) could not be encrypted")
+        return None
+    return updates, removals, blobs, hashed
+
+def stage_snapshot(changes, mirror, extra=()):
+    """Write what encrypt_changes found into the private index, marking the
+    files' rows pending until a push delivers them; returns the tree."""
+    updates, removals, blobs, hashed = changes
+    tree, blobs = write_snapshot_tree(updates + list(extra), removals, blobs)
+    with closing(open_index()) as index, index:
+        for rel, entry in hashed.items():
+            if entry is None:
+                index.execute("DELETE FROM files WHERE path = ?", (rel,))
+                continue
+            path, st, digest, chunks, bundle = entry
+            enc_st = stat_or_none(LOCAL_DIR / path) if mirror and bundle is None else None
+            index_put(index, rel, st, digest, enc_st, blobs[path], pending=True, chunks=chunks,
+                      bundle=bundle)
+        index.executemany("DELETE FROM files WHERE path = ? AND bundle IS NULL",
+                          ((path[len("encrypted/"):-4],) for path in removals
+                           if path.startswith("encrypted/")))
+    stale = unreferenced_chunks()
+    if stale:
+        tree, _ = write_snapshot_tree([], stale)
+    return tree
+
+@recorded("stage")
+def stage_changes(paths=None):
+    """Encrypt changes into the private index now, for the next push to send."""
+    mirror = storage_mode() == "mirror"
+    if mirror:
+        (LOCAL_DIR / "encrypted").mkdir(exist_ok=True)
+    if paths is None:
+        paths, journal_seq = read_journal()
+    else:
+        journal_seq = journal_version()
+    with stage("prepare"):
+        backend = get_backend()
+        prepare_snapshot_index()
+    changes = encrypt_changes(backend, mirror, paths)
+    if changes is None:
+        return False
+    updates, removals, blobs, hashed = changes
+    if hashed or removals:
+        PUSH_PENDING_FILE.touch()
+        with stage("snapshot tree"):
+            stage_snapshot(changes, mirror)
+    else:
+        RUN.status = "noop"
+    clear_journal(journal_seq, paths)
+    return True
+
+@recorded("push")
+def push_courses(repo_url, paths=None, lease=None):
+    """Encrypt what changed and replace the remote snapshot with it.
+
+    Given lease (a commit id, or "" for none), the remote is only replaced
+    if its main is still that commit, as sync pulled it.
+    """
+    if not any(COURSES_DIR.iterdir()):
+        RUN.status = "noop"
+        print("No course files found to push.")
+        return
+
+    mirror = storage_mode() == "mirror"
+    if mirror:
+        (LOCAL_DIR / "encrypted").mkdir(exist_ok=True)
+    # While `watch` runs, its journal says which paths changed; otherwise
+    # (paths None and no watcher) the whole tree is compared.
+    if paths is None:
+        paths, journal_seq = read_journal()
+    else:
+        journal_seq = journal_version()
+
+    # Marks a push in progress until it reaches the remote, so a run that
+    # changed the snapshot but died before pushing is never taken for a no-op.
+    pending = PUSH_PENDING_FILE.exists()
+    PUSH_PENDING_FILE.touch()
+    with stage("prepare"):
+        backend = get_backend()
+        prepare_snapshot_index()
+
+    print("🔒 Synchronizing encrypted directory..." if mirror
+          else "🔒 Encrypting changed files into the object store...")
+    changes = encrypt_changes(backend, mirror, paths)
+    if changes is None:
+        print(f"❌ {RUN.failures} file(s) could not be encrypted, nothing was pushed.")
+        return
+    hashed, removals = changes[3], changes[1]
+
+    # --- Generate README.md and .gitignore ---
+    with stage("readme"):
+        generate_readme(LOCAL_DIR)
+        write_if_changed(LOCAL_DIR / ".gitignore", GITIGNORE)
+
+    # --- Nothing changed: skip commit, gc and network entirely ---
+    # README.md names this device's paths, so it alone is no reason to push
+    heads = git_output("rev-parse", "main", "origin/main")
+    if (not (hashed or removals or pending) and heads and len(set(heads.split())) == 1
+            and layout_matches("main")):
+        PUSH_PENDING_FILE.unlink()
+        clear_journal(journal_seq, paths)
+        RUN.status = "noop"
+        print("✅ Nothing to push: the remote already has these courses.")
+        return
+
+    # --- Git snapshot (on top of the synced one, built from the change set) ---
+    with stage("snapshot tree"):
+        apply_storage_policy()
+        print("🧹 Creating snapshot...")
+        tree = stage_snapshot(changes, mirror, extra=["README.md", ".gitignore"])
+    clear_journal(journal_seq, paths)
 
-    # --- Remove empty directories in encrypted_dir ---
-    for root, dirs, files in os.walk(encrypted_dir, topdown=False):
-        rootp = Path(root)
-        if rootp == encrypted_dir:
+    if tree == logical_tree("origin/main", backend) and layout_matches("origin/main"):
+        for ref in ("refs/heads/main", SNAPSHOT_REF, SYNCED_REF):
+            subprocess.run(["git", "update-ref", ref, "origin/main"], cwd=LOCAL_DIR, check=True)
+        RUN.status = "noop"
+        print("✅ Nothing to push: the remote already has these courses.")
+    else:
+        with stage("commit"):
+            commit_snapshot(tree, backend)
+
+        # --- Push forced to remote ---
+        with stage("push"):
+            force = "--force" if lease is None else f"--force-with-lease=main:{lease}"
+            pushed = subprocess.run(["git", "push", *(["-q"] if QUIET else []), force,
+                                     "origin", "main"], cwd=LOCAL_DIR)
+            if pushed.returncode != 0 and lease is not None:
+                RUN.fail("the remote changed since it was fetched")
+                print("❌ Another device pushed in the meantime: sync again to merge its changes.")
+                return
+            if pushed.returncode != 0:
+                raise subprocess.CalledProcessError(pushed.returncode, "git push")
+            subprocess.run(["git", "update-ref", SYNCED_REF, "main"], cwd=LOCAL_DIR, check=True)
+        print("✅ Courses encrypted and pushed.")
+    with closing(open_index()) as index, index:
+        index.execute("UPDATE files SET pending = 0 WHERE pending")
+    PUSH_PENDING_FILE.unlink()
+    with stage("maintenance check"):
+        schedule_maintenance()
+
+
+def plan_push():
+    """What a push would do, without encrypting or committing anything.
+
+    Files whose stat moved are hashed to tell edits from files that were
+    only touched, and new paths are matched to ciphertext they would reuse
+    like encrypt_changes does. Refreshes the private index from main if a
+    pull moved it, like `git status` refreshes the index.
+    """
+    mirror = storage_mode() == "mirror"
+    prepare_snapshot_index()
+    paths, _ = read_journal()
+    duplicates = Duplicates(mirror)
+    removed = []
+
+    def candidates():
+        walk = push_walk(mirror) if paths is None else journal_walk(mirror, paths)
+        for action, *args in walk:
+            if action == "file":
+                rel, entry, enc_entry = args
+                st = entry.stat()
+                row = index_get(index, rel)
+                if bundler.active:
+                    bundler.seen.add(rel)
+                bundled = bundler.wants(st.st_size)
+                if not indexed_as_is(row, st, bundled):
+                    enc_st = enc_entry.stat() if mirror and enc_entry else None
+                    yield rel, entry.path, st, enc_st, row, bundled
+            elif action == "delete" and args[1]:
+                removed.append(args[0][len("encrypted/"):-4])
+
+    def classify(task):
+        """None if unchanged, else ("encrypt", None), ("move", old path) or
+        ("copy", path whose ciphertext it shares)."""
+        rel, path, st, enc_st, row, bundled = task
+        digest = duplicates.hash(rel, path, st, row)
+        action = push_action(rel, st, enc_st, row, digest, bundled)
+        if action in ("unchanged", "rehash"):
+            return None
+        if action == "bundle":
+            return "encrypt", None
+        with duplicates.lock:
+            sources = duplicates.sources(digest, rel)
+        if not sources:
+            return "encrypt", None
+        gone, row = sources[0]
+        return ("move" if gone is None else "copy"), row["path"]
+
+    plan = {"command": "push", "encrypt": [], "move": [], "copy": [], "remove": []}
+    moved = set()
+    with closing(open_index()) as index:
+        bundler = Bundler(None, None, index)
+        for (rel, _, st, *_), result, error in run_parallel(classify, candidates(),
+                                                            size=lambda t: t[2].st_size):
+            kind, source = ("encrypt", None) if error else (result or (None, None))
+            if kind == "move" and source in moved:
+                kind = "copy"  # a second copy of a moved file
+            if kind == "encrypt":
+                plan["encrypt"].append({"path": rel, "bytes": st.st_size})
+            elif kind is not None:
+                plan[kind].append({"path": rel, "from": source})
+                if kind == "move":
+                    moved.add(source)
+        if bundler.active:
+            removed += bundler.gone(index, paths)
+    duplicates.close()
+    plan["remove"] = [rel for rel in removed if rel not in moved]
+    plan["bytes"] = sum(f["bytes"] for f in plan["encrypt"])
+    plan["seconds"] = estimate_duration("push", plan["bytes"])
+    return plan
+
+def remote_changes(old, new):
+    """(path, status, new blob) of the encrypted/ and bundles/ entries that
+    differ between snapshots old (None if nothing was pulled yet) and new."""
+    if old:
+        listing = git_output("diff-tree", "-r", "-z", "--no-renames",
+                             logical_tree(old), logical_tree(new), "--", "encrypted/", "bundles/")
+        fields = listing.split("\0")[:-1] if listing else []
+        # ":<old mode> <new mode> <old blob> <new blob> <status>", then the path
+        return [(path, meta.split()[4], meta.split()[3])
+                for meta, path in zip(fields[0::2], fields[1::2])]
+    # nothing materialized yet: every file in the snapshot is new
+    listing = git_output("ls-tree", "-r", "-z", logical_tree(new), "--",
+                         "encrypted/", "bundles/")
+    return [(entry.split("\t", 1)[1], "A", entry.split()[2])
+            for entry in (listing.split("\0")[:-1] if listing else [])]
+
+def arrivals(changes):
+    """Blob -> paths added with it: where files deleted with that blob moved to."""
+    arriving = {}
+    for path, status, blob in changes:
+        if status == "A" and path.startswith("encrypted/") and path.endswith(".age"):
+            arriving.setdefault(blob, []).append(path)
+    return arriving
+
+def going_locally(index, rel):
+    """What a pull does with a course file that went remotely: "keep" it
+    (changed here), "delete" it, or "forget" its index row (it is gone)."""
+    dst = COURSES_DIR / rel
+    st = stat_or_none(dst)
+    if changed_here(index_get(index, rel), dst, st):
+        return "keep"
+    return "delete" if st is not None else "forget"
+
+def remote_deletions(index, changes, rebundled):
+    """What a pull does with each encrypted/ file that changes delete:
+    [(tree path, action, tree path it moves to or None)]. action is
+    "bundled" if it arrives in a bundle (rebundled, see bundled_files),
+    "move" if its blob arrives at another path, else going_locally's."""
+    arriving = arrivals(changes)
+    deletions = []
+    for path, status, _ in changes:
+        if status != "D" or not path.startswith("encrypted/") or not path.endswith(".age"):
             continue
-        if not any(rootp.iterdir()):
-            try:
-                print(f"🗑️ Removing empty directory: {rootp}")
-                rootp.rmdir()
-            except Exception as e:
-                print(f"❌ Failed to remove dir {rootp}: {e}")
-
-    # --- Generate README.md ---
-    generate_readme(LOCAL_DIR)
-
-    # --- Update .gitignore ---
-    gitignore_path = LOCAL_DIR / ".gitignore"
-    with open(gitignore_path, "w") as f:
-        f.write("# Local sensitive / plaintext\n")
-        f.write("config/\n")
-        f.write("courses/\n")
-        f.write("\n# Keep encrypted files (in encrypted/ or repo root) and README\n")
-        f.write("!.gitignore\n")
-        f.write("!README.md\n")
-
-    # --- Git snapshot (single commit) ---
-    print("🧹 Creating single-commit snapshot to avoid large history...")
-
-    subprocess.run(["git", "checkout", "--orphan", "temp-branch"], cwd=LOCAL_DIR, check=True)
-    subprocess.run(["git", "add", "-A"], cwd=LOCAL_DIR, check=True)
-    subprocess.run(["git", "commit", "-m", "Snapshot: update courses and README"], cwd=LOCAL_DIR, check=True)
-    subprocess.run(["git", "branch", "-D", "main"], cwd=LOCAL_DIR, check=True)
-    subprocess.run(["git", "branch", "-m", "main"], cwd=LOCAL_DIR, check=True)
-    subprocess.run(["git", "reflog", "expire", "--expire=now", "--all"], cwd=LOCAL_DIR, check=True)
-    subprocess.run(["git", "gc", "--prune=now", "--aggressive"], cwd=LOCAL_DIR, check=True)
-
-    # --- Push forced to remote ---
-    subprocess.run(["git", "push", "--force", "origin", "main"], cwd=LOCAL_DIR, check=True)
-    print("✅ Courses encrypted and pushed (history reset).")
-
-
-
-def pull_courses():
+        rel = path[len("encrypted/"):-len(".age")]
+        action = "bundled" if rel in rebundled else going_locally(index, rel)
+        targets = arriving.get(index_get(index, rel)["blob"]) if action == "delete" else None
+        deletions.append((path, "move", targets.pop()) if targets else (path, action, None))
+    return deletions
+
+def remote_updates(changes, moved):
+    """(tree path, blob) of the encrypted/ files a pull decrypts: added or
+    modified, except those whose plaintext moves there (moved)."""
+    return [(path, blob) for path, status, blob in changes
+            if status != "D" and path.startswith("encrypted/") and path.endswith(".age")
+            and path not in moved]
+
+def bundle_updates(index, directory, members):
+    """Sort the files of a pulled bundle: ([(path, data, digest)] that
+    changed, paths whose content is already indexed, paths that left it)."""
+    changed, same, names = [], [], set()
+    for name, data, digest in members:
+        rel = f"{directory}/{name}" if directory else name
+        names.add(rel)
+        row = index_get(index, rel)
+        if row is not None and row["hash"] == digest:
+            same.append(rel)
+        else:
+            changed.append((rel, data, digest))
+    left = [rel for (rel,) in index.execute("SELECT path FROM files WHERE bundle = ?",
+                                            (directory,)).fetchall() if rel not in names]
+    return changed, same, left
+
+def removed_bundle_files(index, removed):
+    """Indexed files whose bundle is among the tree paths removed."""
+    if not removed:
+        return []
+    key = chunk_key()
+    return [rel for (directory,) in index.execute(
+                "SELECT DISTINCT bundle FROM files WHERE bundle IS NOT NULL").fetchall()
+            if bundle_path(directory, key) in removed
+            for (rel,) in index.execute("SELECT path FROM files WHERE bundle = ?",
+                                        (directory,)).fetchall()]
+
+def plan_pull():
+    """What a pull of the last fetched snapshot would do, without fetching.
+
+    Sizes are those of the ciphertext to read, except for bundled files:
+    changed bundles are decrypted (locally) to tell which of their files
+    changed, and those count their own size. A chunked file counts only
+    its manifest.
+    """
+    plan = {"command": "pull", "decrypt": [], "move": [], "delete": [], "keep": []}
+    new = git_output("rev-parse", "--verify", "-q", "origin/main^{commit}")
+    old = git_output("rev-parse", "--verify", "-q", SYNCED_REF + "^{commit}")
+    changes = remote_changes(old, new) if new and old != new else []
+    relative = lambda path: path[len("encrypted/"):-len(".age")]
+    bundles = [(path, blob) for path, status, blob in changes
+               if path.startswith("bundles/") and status != "D"]
+    removed_bundles = {path for path, status, _ in changes
+                       if path.startswith("bundles/") and status == "D"}
+    opened = open_bundles(bundles, get_backend(), new) if bundles else []
+    for (path, _), _, error in opened:
+        if error:
+            raise ClassGitError(f"could not decrypt {path}: {error}")
+
+    def going(rel):
+        action = going_locally(index, rel)
+        if action != "forget":
+            plan[action].append(rel)
+
+    with closing(open_index()) as index:
+        moved = set()
+        for path, action, target in remote_deletions(index, changes, bundled_files(opened)):
+            if action == "move":
+                moved.add(target)
+                plan["move"].append({"path": relative(target), "from": relative(path)})
+            elif action in ("keep", "delete"):
+                plan[action].append(relative(path))
+        wanted = remote_updates(changes, moved)
+        sizes = blob_sizes({blob for _, blob in wanted})
+        plan["decrypt"] = [{"path": relative(path), "bytes": sizes.get(blob, 0)}
+                           for path, blob in wanted]
+        for rel in removed_bundle_files(index, removed_bundles):
+            going(rel)
+        for _, (directory, members, _), _ in opened:
+            changed, _, left = bundle_updates(index, directory, members)
+            plan["decrypt"] += [{"path": rel, "bytes": len(data)} for rel, data, _ in changed]
+            for rel in left:
+                going(rel)
+    plan["bytes"] = sum(f["bytes"] for f in plan["decrypt"])
+    plan["seconds"] = estimate_duration("pull", plan["bytes"])
+    return plan
+
+def print_plan(plan):
+    verb = {"encrypt": "🔒 encrypt", "decrypt": "🔓 decrypt", "move": "🚚 move", "copy": "🔗 share",
+            "remove": "🗑️ remove", "delete": "🗑️ delete", "keep": "⚠️ keep (modified here)"}
+    for kind, label in verb.items():
+        for entry in plan.get(kind, []):
+            if isinstance(entry, str):
+                print(f"{label} {entry}")
+            elif "from" in entry:
+                print(f"{label} {entry['from']} → {entry['path']}")
+            else:
+                print(f"{label} {entry['path']} ({entry['bytes'] / 1024:.0f} KiB)")
+    files = len(plan.get("encrypt", plan.get("decrypt", [])))
+    summary = f"{files} file(s) to {'encrypt' if plan['command'] == 'push' else 'decrypt'}, " \
+              f"{plan['bytes'] / 1048576:.1f} MiB"
+    if plan["seconds"] is not None:
+        summary += f", about {plan['seconds']:.0f} s at the speed of recent {plan['command']} runs"
+    print(f"📋 {plan['command'].capitalize()} plan: {summary}.")
+
+def fetch_remote():
+    """Fetch origin; False if that failed."""
+    fetch = subprocess.run(["git", "fetch", *(["-q"] if QUIET else []), "origin"], cwd=LOCAL_DIR)
+    return fetch.returncode == 0
+
+@recorded("pull")
+def pull_courses(fetch=True):
+    """Materialize origin/main in COURSES_DIR, fetching it first unless
+    fetch is False (sync has just fetched it)."""
     print("⬇️ Pulling latest encrypted files from remote...")
 
-    # --- fetch and force align with origin/main if divergence ---
-    fetch = subprocess.run(["git", "fetch", "origin"], cwd=LOCAL_DIR)
-    if fetch.returncode != 0:
-        print("❌ Failed to fetch from remote.")
+    # --- fetch, then align main with origin/main ---
+    if fetch:
+        with stage("fetch"):
+            fetched = fetch_remote()
+        if not fetched:
+            RUN.fail("fetch failed")
+            print("❌ Failed to fetch from remote.")
+            return
+    new = git_output("rev-parse", "--verify", "-q", "origin/main^{commit}")
+    if new is None:
+        RUN.fail("no origin/main")
+        print("❌ No origin/main found after fetch. Check remote repo contents.")
         return
 
-    # check divergence
-    status = subprocess.run(["git", "status", "--porcelain=2", "--branch"],
-                            cwd=LOCAL_DIR, capture_output=True, text=True)
-    if "branch.ab" in status.stdout and "+" in status.stdout:
-        print("⚠️ Local branch diverged from remote. Resetting to origin/main...")
-        reset = subprocess.run(["git", "reset", "--hard", "origin/main"], cwd=LOCAL_DIR)
-        if reset.returncode != 0:
-            print("❌ Failed to reset to remote branch.")
-            return
-    else:
-        # normal fast-forward pull
-        pull = subprocess.run(["git", "pull", "--ff-only"], cwd=LOCAL_DIR)
-        if pull.returncode != 0:
-            print("⚠️ Pull failed, forcing reset to remote state...")
-            subprocess.run(["git", "reset", "--hard", "origin/main"], cwd=LOCAL_DIR)
+    # Nothing is checked out: ciphertext is read straight from the fetched
+    # objects, and main just follows the remote.
+    mirror = storage_mode() == "mirror"
+    subprocess.run(["git", "update-ref", "refs/heads/main", new], cwd=LOCAL_DIR, check=True)
 
     encrypted_dir = LOCAL_DIR / "encrypted"
-    decrypted_dir = Path.home() / "ClassGit" / "courses"
+    decrypted_dir = COURSES_DIR
     decrypted_dir.mkdir(parents=True, exist_ok=True)
 
-    if not encrypted_dir.exists():
-        print("❌ No encrypted/ directory found after sync. Check remote repo contents.")
-        return
+    # --- Work out what changed since the last materialized snapshot ---
+    with stage("diff"):
+        old = git_output("rev-parse", "--verify", "-q", SYNCED_REF + "^{commit}")
+        if old == new:
+            RUN.status = "noop"
+            print("✅ Courses already up to date.")
+            return
+        changes = remote_changes(old, new)
 
-    # Iterate through all .age files and decrypt them
-    for root, _, files in os.walk(encrypted_dir):
-        for file in files:
-            if file.endswith(".age"):
-                src = Path(root) / file
-                relative = src.relative_to(encrypted_dir)
-                dst = decrypted_dir / relative.with_suffix("")
+    def relative(path):
+        return Path(path).relative_to("encrypted").with_suffix("").as_posix()
 
-                dst.parent.mkdir(parents=True, exist_ok=True)
-                cmd = [
-                    "age", "-d",
-                    "-i", str(AGE_KEY_PATH),
-                    "-o", str(dst),
-                    str(src)
-                ]
-                print(f"🔓 Decrypting {src} → {dst}")
-                try:
-                    subprocess.run(cmd, check=True)
-                except subprocess.CalledProcessError:
-                    print(f"❌ Failed to decrypt {src}")
+    # --- Remove plaintext of files deleted remotely, or move it along ---
+    # A file moved remotely keeps its ciphertext blob: its local copy is
+    # moved to the new path instead of being deleted and decrypted again.
+    moved = set()
+    kept = []  # (path, conflict copy) of files changed both here and remotely
+    backend = get_backend()
+    bundles = [(path, blob) for path, status, blob in changes
+               if path.startswith("bundles/") and status != "D"]
+    removed_bundles = {path for path, status, _ in changes
+                       if path.startswith("bundles/") and status == "D"}
+    # a file that left encrypted/ may have moved into a bundle: the bundles
+    # stage writes it then, only if it changed, instead of it being deleted here
+    opened = None
+    if bundles and any(status == "D" and path.startswith("encrypted/") for path, status, _ in changes):
+        with stage("bundles"):
+            opened = open_bundles(bundles, backend, new)
+    rebundled = bundled_files(opened or [])
+    with stage("delete"):
+        with closing(open_index()) as index, index:
+            for path, action, target in remote_deletions(index, changes, rebundled):
+                rel = relative(path)
+                dst = decrypted_dir / rel
+                if action == "keep":
+                    print(f"⚠️ Keeping {dst}: removed remotely but modified locally")
+                    continue
+                if action == "move":
+                    new_rel = relative(target)
+                    new_dst = decrypted_dir / new_rel
+                    if changed_here(index_get(index, new_rel), new_dst, stat_or_none(new_dst)):
+                        kept.append((new_rel, keep_local_version(new_dst)))
+                    new_dst.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(dst, new_dst)
+                    prune_empty_dirs(dst.parent, decrypted_dir)
+                    if mirror and (LOCAL_DIR / path).exists():
+                        (LOCAL_DIR / target).parent.mkdir(parents=True, exist_ok=True)
+                        os.replace(LOCAL_DIR / path, LOCAL_DIR / target)
+                        prune_empty_dirs((LOCAL_DIR / path).parent, encrypted_dir)
+                    index.execute("UPDATE OR REPLACE files SET path = ? WHERE path = ?",
+                                  (new_rel, rel))
+                    moved.add(target)
+                    print(f"🚚 Moved {dst} → {new_dst} (moved remotely)")
+                    report_progress("moved", new_rel)
+                    continue
+                if action == "delete":
+                    print(f"🗑️ Removing {dst} (deleted remotely)")
+                    RUN.deleted += 1
+                    report_progress("deleted", rel)
+                    dst.unlink()
+                    prune_empty_dirs(dst.parent, decrypted_dir)
+                if mirror:
+                    (LOCAL_DIR / path).unlink(missing_ok=True)
+                    prune_empty_dirs((LOCAL_DIR / path).parent, encrypted_dir)
+                if action != "bundled":  # the bundles stage updates its row
+                    index.execute("DELETE FROM files WHERE path = ?", (rel,))
+
+    # --- Decrypt added and modified files ---
+    with stage("prepare"):
+        wanted = remote_updates(changes, moved)
+        sizes = blob_sizes({blob for _, blob in wanted})
+        # files changed here and remotely: this device's version is kept beside the remote one
+        with closing(open_index()) as index:
+            for path, _ in wanted:
+                dst = decrypted_dir / relative(path)
+                if changed_here(index_get(index, relative(path)), dst, stat_or_none(dst)):
+                    kept.append((relative(path), keep_local_version(dst)))
+        chunk_blobs = tree_blobs(new, "chunks/")
+        dictionary_blobs = tree_blobs(new, "dicts/")
+
+    def write_atomically(dst, write):
+        """Write dst through a temp file renamed over it, so a reader sees
+        either the old file or the complete new one, never half of it."""
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dst.parent, prefix=".", suffix=TMP_SUFFIX)
+        os.close(fd)
+        try:
+            result = write(tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        return result
+
+    def copy_blob(blob, tmp):
+        with blob_stream(blob) as pipe, open(tmp, "wb") as out:
+            shutil.copyfileobj(pipe, out, HASH_BUFFER_SIZE)
+
+    def decrypt_and_hash(task):
+        path, blob = task
+        size = sizes.get(blob, 0)
+        streamed = size > STREAM_MIN  # never held in memory, plaintext neither
+        data = None if streamed else reader.read(blob)
+        if mirror:
+            write_atomically(LOCAL_DIR / path, (lambda tmp: copy_blob(blob, tmp)) if streamed
+                             else (lambda tmp: Path(tmp).write_bytes(data)))
+
+        def decrypt(tmp):
+            chunks, read = None, size if streamed else len(data)
+            with timed_file("decrypt", relative(path), read):
+                if not streamed:
+                    backend.decrypt_bytes(data, tmp)
+                elif mirror:
+                    backend.decrypt(LOCAL_DIR / path, tmp)
+                else:
+                    with blob_stream(blob) as pipe:
+                        backend.decrypt_from(pipe, tmp)
+                header = frame_header(tmp)
+                if header == CHUNK_MAGIC:
+                    chunks, chunk_bytes = assemble_chunks(tmp, reader, backend, chunk_blobs,
+                                                          dictionaries, chunk_slots)
+                    read += chunk_bytes
+                elif header is not None:
+                    Path(tmp).write_bytes(unpack(Path(tmp).read_bytes(), dictionaries))
+            return hash_file(tmp), chunks, read
+        return write_atomically(decrypted_dir / relative(path), decrypt)
+
+    with stage("decrypt"):
+        failed = 0
+        with BlobReader() as reader, closing(open_index()) as index, index:
+            dictionaries = Dictionaries(reader, backend, dictionary_blobs)
+            chunk_slots = threading.Semaphore(JOBS)  # chunks held in memory, see assemble_chunks
+            for (path, blob), result, error in run_parallel(decrypt_and_hash, wanted,
+                                                            size=lambda t: sizes.get(t[1], 0)):
+                rel = relative(path)
+                dst = decrypted_dir / rel
+                if error:
+                    print(f"❌ Failed to decrypt {path}: {error}")
+                    failed += 1
+                    continue
+                digest, chunks, read = result
+                print(f"🔓 Decrypted {path} → {dst}")
+                RUN.files += 1
+                RUN.bytes += read
+                report_progress("decrypted", rel, read)
+                # remember what was written so the next push doesn't re-encrypt it
+                index_put(index, rel, dst.stat(), digest,
+                          stat_or_none(LOCAL_DIR / path) if mirror else None, blob, chunks=chunks)
+
+    # --- Unpack added and modified bundles, drop files that left them ---
+    def drop(index, rel):
+        """Delete a bundled file that went remotely, unless it was modified here."""
+        dst = decrypted_dir / rel
+        action = going_locally(index, rel)
+        if action == "keep":
+            print(f"⚠️ Keeping {dst}: removed remotely but modified locally")
+            return
+        if action == "delete":
+            print(f"🗑️ Removing {dst} (deleted remotely)")
+            RUN.deleted += 1
+            report_progress("deleted", rel)
+            dst.unlink()
+            prune_empty_dirs(dst.parent, decrypted_dir)
+        index.execute("DELETE FROM files WHERE path = ?", (rel,))
 
+    if bundles or removed_bundles:
+        with stage("bundles"), closing(open_index()) as index, index:
+            if opened is None:
+                opened = open_bundles(bundles, backend, new)
+            for rel in removed_bundle_files(index, removed_bundles):
+                drop(index, rel)
+            for (path, blob), result, error in opened:
+                if error:
+                    print(f"❌ Failed to decrypt {path}: {error}")
+                    failed += 1
+                    continue
+                directory, members, read = result
+                RUN.bytes += read
+                changed, same, left = bundle_updates(index, directory, members)
+                # not changed remotely: local edits, if any, are left for the next push
+                index.executemany("UPDATE files SET blob = ?, bundle = ? WHERE path = ?",
+                                  [(blob, directory, rel) for rel in same])
+                for rel, data, digest in changed:
+                    dst = decrypted_dir / rel
+                    if changed_here(index_get(index, rel), dst, stat_or_none(dst)):
+                        kept.append((rel, keep_local_version(dst)))
+                    write_atomically(dst, lambda tmp: Path(tmp).write_bytes(data))
+                    print(f"🔓 Unbundled {rel} → {dst}")
+                    RUN.files += 1
+                    report_progress("decrypted", rel, len(data))
+                    index_put(index, rel, dst.stat(), digest, None, blob, bundle=directory)
+                for rel in left:
+                    drop(index, rel)
+    RUN.conflicts = drop_identical(kept)
+    with stage("maintenance check"):
+        schedule_maintenance()
 
+    if failed:
+        RUN.failures = failed
+        RUN.fail(f"{failed} file(s) could not be decrypted")
+        print(f"⚠️ {failed} file(s) failed to decrypt, they will be retried on the next pull.")
+        return
+    subprocess.run(["git", "update-ref", SYNCED_REF, new], cwd=LOCAL_DIR, check=True)
+    print("✅ Courses pulled and decrypted.")
+
+def prune_empty_dirs(path, stop):
+    """Remove path and its parents while they are empty, up to stop."""
+    while path != stop and path.is_relative_to(stop):
+        try:
+            path.rmdir()
+        except OSError:
+            return
+        path = path.parent
 
-def add_device():
-    new_path = Path(input("Enter full path to copy your age key for a new device: ").strip())
+def add_device(new_path=None):
+    new_path = Path(new_path or input("Enter full path to copy your age key for a new device: ").strip())
     new_path.parent.mkdir(parents=True, exist_ok=True)
     shutil.copy(AGE_KEY_PATH, new_path)
     print(f"🔑 Key copied to {new_path}")
 
 def status():
-    run("git status", cwd=LOCAL_DIR)
+    """What is not pushed yet, not pulled yet and in conflict.
+
+    Goes by the file index like plan_push and plan_pull: only files whose
+    stat moved are hashed, nothing is decrypted, and the remote is known as
+    of the last fetch. Returns {"local": [...], "remote": [...],
+    "conflicts": [...]} with a {"path", "change"} per file.
+    """
+    push, pull = plan_push(), plan_pull()
+    local = {}
+    with closing(open_index()) as index:
+        for entry in push["encrypt"]:
+            known = index_get(index, entry["path"]) is not None
+            local[entry["path"]] = "modified" if known else "added"
+        for entry in push["copy"]:
+            local[entry["path"]] = "added"
+        for entry in push["move"]:
+            local[entry["path"]] = f"moved from {entry['from']}"
+        for rel in push["remove"]:
+            local[rel] = "deleted"
+        # encrypted by watch or an interrupted push, but not pushed
+        synced = logical_tree(SYNCED_REF) or EMPTY_TREE
+        env = dict(os.environ, GIT_INDEX_FILE=str(SNAPSHOT_INDEX))
+        listing = subprocess.run(["git", "diff-index", "--cached", "-z", "--name-status", synced,
+                                  "--", "encrypted/"], cwd=LOCAL_DIR, env=env, text=True,
+                                 capture_output=True, check=True).stdout.split("\0")[:-1]
+        for change, path in zip(listing[0::2], listing[1::2]):
+            local.setdefault(path[len("encrypted/"):-len(".age")],
+                             "staged, deleted" if change == "D" else "staged")
+        for (rel,) in index.execute("SELECT path FROM files WHERE pending AND bundle IS NOT NULL"):
+            local.setdefault(rel, "staged")
+        remote = {}
+        for entry in pull["decrypt"]:
+            known = index_get(index, entry["path"]) is not None
+            remote[entry["path"]] = "modified" if known else "added"
+    for entry in pull["move"]:
+        remote[entry["path"]] = f"moved from {entry['from']}"
+    for rel in pull["delete"]:
+        remote.setdefault(rel, "deleted")  # unless it comes back, bundled or alone
+    conflicts = {rel: (local[rel], change) for rel, change in remote.items() if rel in local}
+    conflicts.update((rel, ("modified", "deleted")) for rel in pull["keep"])
+    listed = lambda changes: [{"path": rel, "change": change}
+                              for rel, change in sorted(changes.items()) if rel not in conflicts]
+    return {"local": listed(local), "remote": listed(remote),
+            "conflicts": [{"path": rel, "change": f"{here} here, {there} remotely",
+                           "local": here, "remote": there}
+                          for rel, (here, there) in sorted(conflicts.items())]}
+
+def print_status(report):
+    sections = (("local", "⬆️ Not pushed yet"), ("remote", "⬇️ Not pulled yet (as of the last fetch)"),
+                ("conflicts", "⚠️ Changed on both sides"))
+    for key, title in sections:
+        if report[key]:
+            print(f"{title}:")
+            for entry in report[key]:
+                print(f"   {entry['path']}  ({entry['change']})")
+    if not any(report[key] for key, _ in sections):
+        print("✅ Courses are in sync (as of the last fetch).")
+
+# -----------------------------
+# Sync
+# -----------------------------
+# `sync` fetches, pulls, then pushes. SYNCED_REF is the snapshot both
+# sides last agreed on, so the pull only brings what changed remotely since
+# then and the push only what changed here. A file changed on both sides
+# keeps both versions: the pull renames the local one (edited, or staged and
+# not pushed) to a conflict copy before writing the remote one, bundled or
+# not, and the copy goes up with the push. The push only
+# replaces the snapshot sync pulled, never one another device pushed in
+# the meantime.
+def conflict_copy(path):
+    """A free name beside path for this device's version of a file in conflict."""
+    stamp = f"conflict {platform.node() or 'this device'} {time.strftime('%Y-%m-%d %H%M')}"
+    copy, n = path.with_name(f"{path.stem} ({stamp}){path.suffix}"), 1
+    while copy.exists():
+        n += 1
+        copy = path.with_name(f"{path.stem} ({stamp} {n}){path.suffix}")
+    return copy
+
+def keep_local_version(src):
+    """Rename a course file changed here to a conflict copy, making way for
+    the remote version; returns the copy's path relative to COURSES_DIR."""
+    copy = conflict_copy(src)
+    os.replace(src, copy)
+    print(f"⚠️ {src} changed on both sides, keeping this device's version as {copy.name}")
+    return copy.relative_to(COURSES_DIR).as_posix()
+
+def drop_identical(kept):
+    """Delete the conflict copies that match what the pull wrote (the same
+    change made on both sides); returns the others as {"path", "copy"}."""
+    left = []
+    for rel, copy in kept:
+        dst, copy_path = COURSES_DIR / rel, COURSES_DIR / copy
+        if dst.exists() and hash_file(dst) == hash_file(copy_path):
+            copy_path.unlink()
+        else:
+            left.append({"path": rel, "copy": copy})
+    return left
+
+# -----------------------------
+# Watch mode
+# -----------------------------
+# `watch` keeps a push's change detection off the full tree: inotify events
+# under COURSES_DIR go into the journal table of the file index, files are
+# encrypted into the private index once they stop changing, and a push goes
+# out every interval. While the watcher runs (config/watch.json names a
+# live, reconciled watcher) any push reads the journal instead of walking.
+WATCH_DEBOUNCE = 2.0  # seconds without events before a file counts as written
+WATCH_WRITE_TIMEOUT = 60.0  # ... or since its last write if it was never closed
+WATCH_INTERVAL = 300  # seconds between pushes, config/watch_interval.txt overrides
+
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_ISDIR = 0x4000, 0x8000, 0x01000000, 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_ONLYDIR)
+WRITE_DONE = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+class Inotify:
+    """inotify watches on every directory of a tree, through libc."""
+
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.errno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = str(root)
+        self.dirs = {}  # watch descriptor -> directory relative to root
+
+    def watch_tree(self, rel):
+        for path, dirs, _ in os.walk(os.path.join(self.root, rel)):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                raise OSError(self.errno(), f"cannot watch {path} (raise "
+                              "fs.inotify.max_user_watches?)")
+            sub = os.path.relpath(path, self.root)
+            self.dirs[wd] = "" if sub == "." else Path(sub).as_posix()
+
+    def unwatch_tree(self, rel):
+        for wd, path in list(self.dirs.items()):
+            if path == rel or path.startswith(rel + "/"):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[wd]
+
+    def read(self):
+        """Pending events as (path relative to root, mask); path None on overflow."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+                name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+                offset += 16 + length
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                elif mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                elif wd in self.dirs and name:
+                    base = self.dirs[wd]
+                    events.append((f"{base}/{name}" if base else name, mask))
+
+    def close(self):
+        os.close(self.fd)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def watcher_state():
+    try:
+        state = json.loads(WATCH_STATE.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+    return state if pid_alive(state["pid"]) else None
+
+def watcher_ready():
+    state = watcher_state()
+    return bool(state and state["ready"])
+
+def watch(repo_url, session=nullcontext):
+    """Journal changes, encrypt them as they settle and push every interval.
+
+    Everything but the wait for events runs inside session(), which
+    Workspace.watch uses to hold its workspace only while there is work.
+    """
+    if not sys.platform.startswith("linux"):
+        print("❌ Watch mode needs Linux (inotify).")
+        return EXIT_FAILED
+    with session():
+        state = watcher_state()
+        if state:
+            print(f"👀 Already watching (pid {state['pid']}).")
+            return EXIT_BUSY
+        interval = float(read_setting("watch_interval", WATCH_INTERVAL))
+        notify = Inotify(COURSES_DIR)
+        notify.watch_tree("")
+        state = {"pid": os.getpid(), "started": time.time(), "ready": False}
+        WATCH_STATE.write_text(json.dumps(state))
+    settling = {}  # path -> [time of its last event, still being written]
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # clean up when a service manager stops us
+    try:
+        # events from here on are journaled, so one scan covers the rest
+        with session():
+            print(f"👀 Watching {COURSES_DIR}, reconciling with one scan...")
+            stage_changes(None)
+            WATCH_STATE.write_text(json.dumps(dict(state, ready=True)))
+            print(f"👀 Ready. Changes are pushed every {interval:.0f}s; Ctrl+C to stop.")
+        last_push = 0
+        while True:
+            select.select([notify.fd], [], [], 1.0)
+            with session():
+                now = time.monotonic()
+                changed = []
+                for rel, mask in notify.read():
+                    if rel is None:
+                        print("⚠️ Too many changes at once, the next push rescans everything.")
+                        changed.append("")
+                        continue
+                    if rel.endswith(TMP_SUFFIX):
+                        continue
+                    if mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            notify.watch_tree(rel)  # its files may predate the watch
+                        elif mask & IN_MOVED_FROM:
+                            notify.unwatch_tree(rel)
+                    writing = bool(mask & (IN_CREATE | IN_MODIFY)) or (
+                        rel in settling and settling[rel][1] and not mask & WRITE_DONE)
+                    settling[rel] = [now, writing and not mask & IN_ISDIR]
+                    # a directory settles only once nothing inside it changes
+                    parent = os.path.dirname(rel)
+                    while parent:
+                        if parent in settling:
+                            settling[parent][0] = now
+                        parent = os.path.dirname(parent)
+                    changed.append(rel)
+                if changed:
+                    with closing(open_index()) as index, index:
+                        journal_add(index, changed)
+                settled = [rel for rel, (seen, writing) in settling.items()
+                           if now - seen >= (WATCH_WRITE_TIMEOUT if writing else WATCH_DEBOUNCE)]
+                if settled:
+                    for rel in settled:
+                        del settling[rel]
+                    try:
+                        staged = stage_changes(settled)
+                    except Exception as e:
+                        print(f"❌ Could not stage changes: {e}")
+                        staged = False
+                    if not staged:  # still journaled, try again after the next quiet spell
+                        settling.update((rel, [now, False]) for rel in settled)
+                if PUSH_PENDING_FILE.exists() and now - last_push >= interval:
+                    last_push = now
+                    try:
+                        push_courses(repo_url, paths=[])
+                    except Exception as e:
+                        print(f"❌ Push failed, retrying in {interval:.0f}s: {e}")
+    except KeyboardInterrupt:
+        print("\n👀 Stopped watching.")
+    finally:
+        notify.close()
+        with session():
+            WATCH_STATE.unlink(missing_ok=True)
+    return EXIT_OK
+
+# -----------------------------
+# Benchmarks
+# -----------------------------
+# Synthetic course trees are pushed to and pulled from a local bare
+# repository, each scenario in its own interpreter with HOME pointing at a
+# scratch device, so timings include start-up and every git/age process.
+BENCH_SCENARIOS = ["cold push", "warm push", "small-edit push", "cold pull", "incremental pull"]
+BENCH_TOLERANCE = 0.10  # slower than the baseline by more than this is a regression
+BENCH_WORDS = ("lecture theorem proof exercise definition lemma example solution "
+               "chapter section figure table equation remark corollary algorithm "
+               "integral matrix vector entropy protocol compiler semantics").split()
+
+def generate_course_tree(root, files, seed=0, max_size=32 << 20):
+    """Fill root with a reproducible course tree: mostly small text notes,
+    some PDFs and a few recordings, with log-normal sizes."""
+    import random
+    rng = random.Random(seed)
+    total = 0
+    for i in range(files):
+        course = root / f"Course{rng.randrange(max(1, files // 100) + 1):02d}" / f"Week{rng.randrange(14):02d}"
+        course.mkdir(parents=True, exist_ok=True)
+        kind = rng.random()
+        if kind < 0.85:
+            size = min(int(rng.lognormvariate(8.3, 1.0)), max_size)  # ~4 KiB notes
+            words = " ".join(rng.choice(BENCH_WORDS) for _ in range(size // 7 + 1))
+            data = words.encode()[:size]
+            name = f"note{i:05d}.{rng.choice(['md', 'txt', 'tex'])}"
+        elif kind < 0.97:
+            size = min(int(rng.lognormvariate(13.1, 0.8)), max_size)  # ~500 KiB PDFs
+            data, name = rng.randbytes(size), f"slides{i:05d}.pdf"
+        else:
+            size = min(int(rng.lognormvariate(15.9, 0.6)), max_size)  # ~8 MiB videos
+            data, name = rng.randbytes(size), f"recording{i:05d}.mp4"
+        (course / name).write_bytes(data)
+        total += len(data)
+    return total
+
+def edit_course_tree(root, seed=0, fraction=0.01):
+    """The small edit between runs: touch up ~1% of notes, add one, delete one."""
+    import random
+    rng = random.Random(seed + 1)
+    notes = sorted(p for p in root.rglob("note*") if p.is_file())
+    for note in rng.sample(notes, max(1, int(len(notes) * fraction))):
+        with open(note, "a") as f:
+            f.write(" " + " ".join(rng.choice(BENCH_WORDS) for _ in range(50)))
+    (notes[0].parent / "note-added.md").write_text("new " * 300)
+    notes[-1].unlink()
+
+def generate_identity(path):
+    """Write a fresh age identity to path and return its public key."""
+    if shutil.which("age-keygen"):
+        subprocess.run(["age-keygen", "-o", str(path)], check=True, capture_output=True)
+        return subprocess.run(["age-keygen", "-y", str(path)], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    identity = load_pyrage().x25519.Identity.generate()
+    Path(path).write_text(f"# public key: {identity.to_public()}\n{identity}\n")
+    return str(identity.to_public())
+
+def bench_step(home, call):
+    """Run classgit.<call> in a fresh interpreter as the device at home and
+    return its resource usage, children (git, age) included."""
+    code = (f"import sys; sys.path.insert(0, {str(Path(__file__).resolve().parent)!r}); "
+            f"import classgit; classgit.JOBS = {JOBS}; classgit.{call}")
+    env = dict(os.environ, HOME=str(home), USERPROFILE=str(home),
+               GIT_AUTHOR_NAME="ClassGit benchmark", GIT_AUTHOR_EMAIL="bench@classgit",
+               GIT_COMMITTER_NAME="ClassGit benchmark", GIT_COMMITTER_EMAIL="bench@classgit")
+    with open(home / "bench.log", "ab") as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, "-c", code], env=env, stdin=subprocess.DEVNULL,
+                                stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"benchmark step {call} failed, see {home / 'bench.log'}")
+    return {"wall_s": round(wall, 4),
+            "cpu_s": round(usage.ru_utime + usage.ru_stime, 4),
+            "written_bytes": usage.ru_oublock * 512,
+            "peak_rss_kb": usage.ru_maxrss}
+
+def run_benchmark(files=200, seed=0, storage="mirror", workdir=None):
+    """Time the push/pull scenarios on a synthetic tree; returns a result dict."""
+    if not hasattr(os, "wait4"):
+        raise RuntimeError("The benchmark needs a POSIX system (os.wait4).")
+    with tempfile.TemporaryDirectory(prefix="classgit-bench-", dir=workdir) as tmp:
+        tmp = Path(tmp)
+        remote = tmp / "remote.git"
+        subprocess.run(["git", "init", "-q", "--bare", str(remote)], check=True)
+        key = tmp / "age_key.txt"
+        public = generate_identity(key)
+        devices = []
+        for name in ("device-a", "device-b"):
+            config = tmp / name / "ClassGit" / "config"
+            config.mkdir(parents=True)
+            (config / "repo_url.txt").write_text(str(remote))
+            (config / "public_key.txt").write_text(public)
+            (config / "storage.txt").write_text(storage)
+            shutil.copy(key, config / "age_key.txt")
+            bench_step(tmp / name, "configure_repo()")
+            devices.append(tmp / name)
+        a, b = devices
+        courses = a / "ClassGit" / "courses"
+        total = generate_course_tree(courses, files, seed)
+        print(f"⏱️ Benchmarking {files} files ({total / (1 << 20):.1f} MiB), "
+              f"{JOBS} jobs, {storage} storage...")
+
+        push = "push_courses(classgit.REPO_FILE.read_text().strip())"
+        results = {}
+        results["cold push"] = bench_step(a, push)
+        results["warm push"] = bench_step(a, push)
+        edit_course_tree(courses, seed)
+        results["small-edit push"] = bench_step(a, push)
+        results["cold pull"] = bench_step(b, "pull_courses()")
+        edit_course_tree(courses, seed + 1)
+        bench_step(a, push)
+        results["incremental pull"] = bench_step(b, "pull_courses()")
+        return {"files": files, "bytes": total, "seed": seed, "jobs": JOBS,
+                "storage": storage, "scenarios": results}
+
+def report_benchmark(result, baseline=None, tolerance=BENCH_TOLERANCE):
+    """Print the scenario table, against baseline if given; True on regression."""
+    regressed = False
+    print(f"{'scenario':<18} {'wall s':>9} {'cpu s':>9} {'written MiB':>12} {'peak RSS MiB':>13}")
+    for name in BENCH_SCENARIOS:
+        m = result["scenarios"][name]
+        line = (f"{name:<18} {m['wall_s']:>9.3f} {m['cpu_s']:>9.3f} "
+                f"{m['written_bytes'] / (1 << 20):>12.1f} {m['peak_rss_kb'] / 1024:>13.1f}")
+        old = (baseline or {}).get("scenarios", {}).get(name)
+        if old:
+            changes = []
+            for metric in ("wall_s", "cpu_s"):
+                if old[metric] > 0:
+                    delta = m[metric] / old[metric] - 1
+                    changes.append(f"{metric[:-2]} {delta:+.0%}")
+                    regressed |= delta > tolerance
+            line += "   vs baseline: " + ", ".join(changes)
+        print(line)
+    if baseline and (baseline.get("files"), baseline.get("storage")) != (result["files"], result["storage"]):
+        print("⚠️ Baseline was recorded with a different tree size or storage mode.")
+    if regressed:
+        print(f"❌ Slower than the baseline by more than {tolerance:.0%}.")
+    return regressed
+
+# -----------------------------
+# Library API
+# -----------------------------
+class Workspace:
+    """A ClassGit workspace (~/ClassGit unless path is given), driven from Python.
+
+        ws = Workspace("/srv/classgit/alice", on_progress=print)
+        result = ws.push()  # a RunRecord; SyncError if the push failed
+
+    on_progress(event, path, size) hears about every file encrypted,
+    removed, decrypted or deleted; on_stage(name, seconds) about every
+    stage of a push or pull as it ends; last_run is the RunRecord of this
+    workspace's latest push or pull.
+
+    Known limitation: ClassGit's paths, job count, hooks and run record are
+    module globals, not workspace state. Each method points them at its
+    workspace for the duration of the call under a lock shared by every
+    Workspace in the process, so calls on different workspaces run one
+    after the other, never in parallel, and code outside a call that reads
+    those globals sees whichever workspace ran last. Use one process per
+    workspace where syncs must overlap.
+    """
+    _lock = threading.RLock()
+
+    def __init__(self, path=None, jobs=None, on_progress=None, on_stage=None):
+        self.path = Path(path) if path else Path.home() / "ClassGit"
+        self.jobs = jobs
+        self.on_progress = on_progress
+        self.on_stage = on_stage
+        self.last_run = None
+
+    @contextmanager
+    def active(self, need_setup=True):
+        global JOBS, PROGRESS_HOOK, TIMING_HOOK
+        with Workspace._lock:
+            saved = LOCAL_DIR, JOBS, PROGRESS_HOOK, TIMING_HOOK
+            set_workspace_paths(self.path)
+            JOBS = self.jobs or JOBS
+            PROGRESS_HOOK, TIMING_HOOK = self.on_progress, self.on_stage
+            try:
+                if need_setup and not is_set_up():
+                    raise NotSetUpError(f"{self.path} is not set up yet, run setup first")
+                yield
+            finally:
+                set_workspace_paths(saved[0])
+                JOBS, PROGRESS_HOOK, TIMING_HOOK = saved[1:]
+
+    def _sync(self, command, fn, *args):
+        try:
+            profiled(command, fn, *args)
+        except (subprocess.CalledProcessError, CommandError) as e:
+            self.last_run = LAST_RUN
+            raise SyncError(LAST_RUN) from e
+        self.last_run = LAST_RUN
+        if LAST_RUN.status == "failed":
+            raise SyncError(LAST_RUN)
+        return LAST_RUN
+
+    def setup(self, repo_url=None, public_key=None, ask=True):
+        """Create the key, config and repository; asks for whatever is
+        neither given nor saved yet (a UsageError if ask is False)."""
+        with self.active(need_setup=False):
+            missing = [option for option, value, path in (
+                ("--repo-url", repo_url, REPO_FILE), ("--public-key", public_key, PUBLIC_KEY_FILE))
+                if not value and not path.exists()]
+            if missing and not ask:
+                raise UsageError(f"{' and '.join(missing)} needed, setup does not ask questions")
+            CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+            if repo_url:
+                REPO_FILE.write_text(repo_url)
+            if public_key:
+                PUBLIC_KEY_FILE.write_text(public_key)
+            configure_repo()
+
+    def push(self):
+        with self.active():
+            return self._sync("push", push_courses, REPO_FILE.read_text().strip())
+
+    def pull(self):
+        with self.active():
+            return self._sync("pull", pull_courses)
+
+    def sync(self):
+        """Pull, then push (see the Sync section). Returns {"pull", "push",
+        "conflicts"}: the two RunRecords (pull is None while the remote is
+        empty) and the files whose local version was kept as a copy."""
+        with self.active():
+            if not fetch_remote():
+                raise ClassGitError("could not fetch from the remote")
+            remote = git_output("rev-parse", "-q", "--verify", "origin/main^{commit}")
+            pulled = self._sync("pull", pull_courses, False) if remote else None
+            conflicts = pulled.conflicts if pulled else []
+            pushed = self._sync("push", push_courses, REPO_FILE.read_text().strip(), None,
+                                remote or "")
+        return {"pull": pulled, "push": pushed, "conflicts": conflicts}
+
+    def status(self):
+        """Unpushed, unpulled and conflicting files (see status)."""
+        with self.active():
+            return status()
+
+    def plan(self, command="push"):
+        """What a push or pull would do (see plan_push, plan_pull)."""
+        with self.active():
+            return plan_push() if command == "push" else plan_pull()
+
+    def watch(self):
+        """Run the watcher until interrupted. The lock is only held while the
+        watcher works, so other workspaces keep syncing while it waits."""
+        with self.active():
+            repo_url = REPO_FILE.read_text().strip()
+        if watch(repo_url, self.active) == EXIT_BUSY:
+            raise BusyError("a watcher is already running for this workspace")
+
+    def maintenance(self):
+        with self.active():
+            record = run_maintenance()
+        if record is None:
+            raise BusyError("maintenance is already running for this workspace")
+        return record
+
+    def metrics(self, target="-"):
+        """Export the run history (see prometheus_metrics); a workspace set
+        up elsewhere only needs its config directory for that."""
+        with self.active(need_setup=False):
+            if not CONFIG_DIR.is_dir():
+                raise NotSetUpError(f"{self.path} is not set up yet, run setup first")
+            export_metrics(target)
+
+    def add_device(self, key_path):
+        with self.active():
+            add_device(key_path)
 
 # -----------------------------
 # Menu
 # -----------------------------
 def menu():
+    print(LOGO)
     repo_url = configure_repo()
     while True:
         print("""
@@ -310,25 +3487,180 @@ ClassGit Menu
 1. ⬆️ Push courses
 2. ⬇️ Pull courses
 3. 💻 Add a new device
-4. 📋 Show Git status
-5. 🚪 Quit
+4. 📋 Show sync status
+5. 🔄 Sync (pull, then push)
+6. 🚪 Quit
 """)
         choice = input("Select an option: ").strip()
-        if choice == "1":
-            push_courses(repo_url)
-        elif choice == "2":
-            pull_courses()
-        elif choice == "3":
-            add_device()
-        elif choice == "4":
-            status()
-        elif choice == "5":
-            exit()
-        else:
-            print("❓ Invalid option, try again.")
+        try:
+            if choice == "1":
+                profiled("push", push_courses, repo_url)
+            elif choice == "2":
+                profiled("pull", pull_courses)
+            elif choice == "3":
+                add_device()
+            elif choice == "4":
+                print_status(status())
+            elif choice == "5":
+                Workspace(LOCAL_DIR, jobs=JOBS).sync()
+            elif choice == "6":
+                exit()
+            else:
+                print("❓ Invalid option, try again.")
+        except (ClassGitError, subprocess.CalledProcessError) as e:
+            print(f"❌ {e}")
 
 # -----------------------------
 # Main
 # -----------------------------
+# Without a command (and on a terminal) ClassGit runs the interactive menu.
+# Commands never prompt, print a JSON summary with --json, and report how
+# they went through the EXIT_* codes.
+def run_command(args):
+    """Run args.command; returns (exit code, details for --json)."""
+    command = args.command
+    workspace = Workspace(getattr(args, "workspace", None), jobs=JOBS)
+    try:
+        if command == "setup":
+            workspace.setup(args.repo_url, args.public_key, ask=False)
+        elif command == "benchmark":
+            result = run_benchmark(args.files, args.seed, args.storage)
+            baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+            regressed = report_benchmark(result, baseline)
+            if args.save_baseline:
+                args.save_baseline.write_text(json.dumps(result, indent=2))
+            return (EXIT_FAILED if regressed else EXIT_OK), {"benchmark": result,
+                                                              "regressed": regressed}
+        elif command == "push":
+            return EXIT_OK, workspace.push().as_dict()
+        elif command == "pull":
+            return EXIT_OK, workspace.pull().as_dict()
+        elif command == "sync":
+            result = workspace.sync()
+            return EXIT_OK, {"pull": result["pull"] and result["pull"].as_dict(),
+                             "push": result["push"].as_dict(), "conflicts": result["conflicts"]}
+        elif command == "status":
+            report = workspace.status()
+            if not args.json:
+                print_status(report)
+            return EXIT_OK, report
+        elif command == "plan":
+            plan = workspace.plan(args.direction)
+            if not args.json:
+                print_plan(plan)
+            return EXIT_OK, plan
+        elif command == "watch":
+            workspace.watch()
+        elif command == "maintenance":
+            return EXIT_OK, workspace.maintenance()
+        elif command == "metrics":
+            workspace.metrics(args.file)
+        elif command == "add-device":
+            workspace.add_device(args.path)
+        return EXIT_OK, {}
+    except SyncError as e:
+        return EXIT_FAILED, e.result.as_dict()
+    except NotSetUpError as e:
+        return EXIT_NOT_SET_UP, {"error": f"{e} (`classgit.py setup`)"}
+    except BusyError as e:
+        return EXIT_BUSY, {"error": str(e)}
+    except UsageError as e:
+        return EXIT_USAGE, {"error": str(e)}
+    except ClassGitError as e:
+        return EXIT_FAILED, {"error": str(e)}
+
+def main():
+    global JOBS, PROFILING, QUIET
+    # options every command takes, before or after the command name
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-j", "--jobs", type=int, default=argparse.SUPPRESS,
+                        help=f"parallel encrypt/decrypt workers (default: {JOBS}, the CPU count)")
+    common.add_argument("--profile", action="store_true", default=argparse.SUPPRESS,
+                        help="time every stage, process and file of each push and pull")
+    common.add_argument("-q", "--quiet", action="store_true", default=argparse.SUPPRESS,
+                        help="print nothing but errors")
+    common.add_argument("--json", action="store_true", default=argparse.SUPPRESS,
+                        help="print only a JSON summary of the result on stdout")
+    common.add_argument("--workspace", type=Path, default=argparse.SUPPRESS, metavar="DIR",
+                        help="the ClassGit folder to work on (default: ~/ClassGit)")
+
+    parser = argparse.ArgumentParser(
+        description="ClassGit: encrypted course storage on Git. Without a command, "
+                    "opens the interactive menu.", parents=[common],
+        epilog=f"exit codes: {EXIT_OK} success, {EXIT_FAILED} failed, {EXIT_USAGE} bad usage, "
+               f"{EXIT_NOT_SET_UP} not set up yet, {EXIT_BUSY} already running")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.add_parser("push", parents=[common], help="encrypt and push changed courses")
+    commands.add_parser("pull", parents=[common], help="pull and decrypt changed courses")
+    commands.add_parser("sync", parents=[common],
+                        help="pull, then push, keeping both versions of files changed on both sides")
+    commands.add_parser("status", parents=[common],
+                        help="show course files not pushed, not pulled or changed on both sides")
+    commands.add_parser("plan", parents=[common],
+                        help="show what a push or pull would do and how long it should take, "
+                             "without doing it").add_argument(
+        "direction", nargs="?", choices=("push", "pull"), default="push")
+    setup = commands.add_parser("setup", parents=[common],
+                                help="create the key and link the repository")
+    setup.add_argument("--repo-url", metavar="URL",
+                       help="HTTPS URL of the GitHub repository (needed the first time)")
+    setup.add_argument("--public-key", metavar="KEY",
+                       help="age public key to encrypt courses to (needed the first time)")
+    commands.add_parser("add-device", parents=[common],
+                        help="copy the age key for another device").add_argument("path")
+    commands.add_parser("watch", parents=[common],
+                        help="keep running: encrypt changes as they happen and push them "
+                             "every config/watch_interval.txt seconds (Linux)")
+    commands.add_parser("maintenance", parents=[common],
+                        help="repack and prune the local repository now")
+    commands.add_parser("metrics", parents=[common],
+                        help="write run-history metrics in Prometheus textfile format"
+                        ).add_argument("file", help="output file, - for stdout")
+    bench = commands.add_parser("benchmark", parents=[common],
+                                help="time push/pull scenarios on a synthetic tree")
+    bench.add_argument("--files", type=int, default=200, metavar="N",
+                       help="files in the synthetic course tree (default: 200)")
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--storage", choices=("mirror", "objects"), default="mirror")
+    bench.add_argument("--baseline", type=Path, metavar="FILE",
+                       help="compare against results saved with --save-baseline")
+    bench.add_argument("--save-baseline", type=Path, metavar="FILE",
+                       help="write the results as JSON for later comparison")
+    args = parser.parse_args()
+    args.json = getattr(args, "json", False)
+    JOBS = max(1, getattr(args, "jobs", JOBS))
+    PROFILING = getattr(args, "profile", False)
+    QUIET = getattr(args, "quiet", False) or args.json
+
+    if args.command is None:
+        if not sys.stdin.isatty():
+            parser.print_help(sys.stderr)
+            return EXIT_USAGE
+        if hasattr(args, "workspace"):
+            set_workspace_paths(args.workspace)
+        menu()
+        return EXIT_OK
+
+    out = sys.stdout
+    if QUIET:
+        # progress goes nowhere, children's included; stdout keeps the JSON
+        sys.stdout.flush()
+        out = os.fdopen(os.dup(1), "w")
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.close(devnull)
+    try:
+        code, details = run_command(args)
+    except Exception as e:
+        code, details = EXIT_FAILED, {"error": f"{type(e).__name__}: {e}"}
+        if not args.json:
+            raise
+    if args.json:
+        out.write(json.dumps({"command": args.command, **details, "exit_code": code}) + "\n")
+    elif code != EXIT_OK and details.get("error"):
+        print(f"❌ classgit {args.command}: {details['error']}", file=sys.stderr)
+    out.flush()
+    return code
+
 if __name__ == "__main__":
-    menu()
+    sys.exit(main())
@@ -0,0 +1,81 @@
+import os
+import random
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import classgit  # noqa: E402
+
+
+@pytest.fixture
+def devices(tmp_path, monkeypatch):
+    """devices(n, **settings): n workspaces sharing a key and a local bare
+    remote, each with config/<name>.txt = value for every setting."""
+    pytest.importorskip("pyrage")
+    for var in ("GIT_AUTHOR", "GIT_COMMITTER"):
+        monkeypatch.setenv(f"{var}_NAME", "ClassGit test")
+        monkeypatch.setenv(f"{var}_EMAIL", "test@classgit")
+    monkeypatch.setattr(classgit, "schedule_maintenance", lambda: None)
+    remote = tmp_path / "remote.git"
+    subprocess.run(["git", "init", "-q", "--bare", str(remote)], check=True)
+    key = tmp_path / "age_key.txt"
+    public_key = classgit.generate_identity(key)
+
+    def make(n=2, **settings):
+        workspaces = []
+        for i in range(n):
+            config = tmp_path / f"device{i}" / "config"
+            config.mkdir(parents=True)
+            (config / "age_key.txt").write_text(key.read_text())
+            for name, value in dict(settings, backend="pyrage").items():
+                (config / f"{name}.txt").write_text(f"{value}\n")
+            ws = classgit.Workspace(tmp_path / f"device{i}")
+            ws.setup(str(remote), public_key)
+            workspaces.append(ws)
+        return workspaces
+    return make
+
+
+def write_courses(ws, files):
+    for rel, data in files.items():
+        path = ws.path / "courses" / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data if isinstance(data, bytes) else data.encode())
+
+
+def read_courses(ws):
+    root = ws.path / "courses"
+    return {path.relative_to(root).as_posix(): path.read_bytes()
+            for path in sorted(root.rglob("*")) if path.is_file()}
+
+
+def round_trip(a, b):
+    """Push a's courses and pull them on b, twice: the second time after an
+    edit, an insert into a large file, a move and a deletion. Returns b's
+    pull records."""
+    rng = random.Random(2)
+    write_courses(a, {
+        "readme.txt": "top\n",
+        "Math/ch1/n1.md": "note 1\n" * 200,
+        "Math/ch1/n2.md": "note 2\n",
+        "Math/ch1/copy.md": "note 2\n",
+        "Math/notes.txt": b"".join(b"%d %x\n" % (i, rng.getrandbits(64)) for i in range(200_000)),
+        "Phys/big.pdf": rng.randbytes(1_500_000),
+    })
+    a.push()
+    records = [b.pull()]
+    assert read_courses(b) == read_courses(a)
+
+    courses = a.path / "courses"
+    write_courses(a, {"Math/ch1/n1.md": "note 1, edited\n", "Phys/new.md": "new\n"})
+    notes = (courses / "Math" / "notes.txt").read_bytes()
+    (courses / "Math" / "notes.txt").write_bytes(notes[:1000] + b"inserted\n" + notes[1000:])
+    os.replace(courses / "Phys" / "big.pdf", courses / "Phys" / "moved.pdf")
+    (courses / "Math" / "ch1" / "n2.md").unlink()
+    a.push()
+    records.append(b.pull())
+    assert read_courses(b) == read_courses(a)
+    return records
@@ -0,0 +1,50 @@
+import subprocess
+
+import pytest
+
+import classgit
+from conftest import read_courses, round_trip, write_courses
+
+
+def test_pack_bundle_read_bundle_round_trip():
+    members = [("a.md", b"first\n", "d1"), ("empty.txt", b"", "d2"),
+               ("b.md", classgit.BUNDLE_MAGIC + b"not a header here", "d3")]
+    plaintext = classgit.pack_bundle("S1/ch1", members)
+
+    assert classgit.read_bundle(plaintext) == ("S1/ch1", members)
+    with pytest.raises(ValueError):
+        classgit.read_bundle(b"plain notes")
+
+
+def test_push_pull_round_trip_with_bundles(devices):
+    a, b = devices(2, bundle_threshold=4)
+    round_trip(a, b)
+
+    tree = subprocess.run(["git", "ls-tree", "-r", "--name-only", "main"], cwd=a.path,
+                          capture_output=True, text=True, check=True).stdout.split()
+    assert "encrypted/Math/ch1/n1.md.age" not in tree
+    assert "encrypted/Math/notes.txt.age" in tree
+    assert any(path.startswith("bundles/") for path in tree)
+
+
+def test_files_moving_into_a_bundle_are_not_rewritten(devices):
+    a, b = devices(2)
+    write_courses(a, {f"S1/n{i}.md": f"note {i}\n" for i in range(4)})
+    a.push()
+    b.pull()
+    (a.path / "config" / "bundle_threshold.txt").write_text("4\n")
+    write_courses(a, {"S1/n0.md": "note 0, edited\n"})
+    a.push()
+
+    events = []
+    b.on_progress = lambda event, path, size: events.append((event, path))
+    record = b.pull()
+
+    assert record.deleted == 0
+    assert events == [("decrypted", "S1/n0.md")]
+    assert read_courses(b) == read_courses(a)
+    (a.path / "config" / "bundle_threshold.txt").unlink()
+    write_courses(a, {"S1/n1.md": "note 1, edited\n"})
+    a.push()
+    b.pull()
+    assert read_courses(b) == read_courses(a)
@@ -0,0 +1,31 @@
+import random
+import subprocess
+
+import classgit
+from conftest import round_trip
+
+
+def test_split_chunks_cuts_stay_put_after_an_insert(tmp_path):
+    rng = random.Random(1)
+    data = b"".join(b"%d %x\n" % (i, rng.getrandbits(64)) for i in range(400_000))
+    edited = data[:3_000_000] + b"inserted line\n" + data[3_000_000:]
+    chunks = {}
+    for name, content in (("before", data), ("after", edited)):
+        path = tmp_path / name
+        path.write_bytes(content)
+        with open(path, "rb") as f:
+            chunks[name] = list(classgit.split_chunks(f))
+
+    assert b"".join(chunks["after"]) == edited
+    assert len(chunks["before"]) > 4
+    changed = set(chunks["after"]) - set(chunks["before"])
+    assert len(changed) == 1 and b"inserted line\n" in changed.pop()
+
+
+def test_push_pull_round_trip_with_chunks(devices):
+    a, b = devices(2, chunk_threshold=1)
+    round_trip(a, b)
+
+    chunks = subprocess.run(["git", "ls-tree", "-r", "--name-only", "main", "chunks/"],
+                            cwd=a.path, capture_output=True, text=True, check=True).stdout.split()
+    assert len(chunks) > 4
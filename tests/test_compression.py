@@ -0,0 +1,38 @@
+import pytest
+
+import classgit
+from conftest import read_courses, round_trip, write_courses
+
+
+@pytest.mark.parametrize("data", [b"", b"plain notes\n", classgit.FRAME_PREFIX + b"looks like a header\n",
+                                  classgit.PACKED_MAGIC + b"raw -\nbody"])
+def test_frame_raw_unpack_round_trip(data):
+    assert classgit.unpack(classgit.frame_raw(data), None) == data
+
+
+def test_compressed_payload_round_trip():
+    data = b"the same sentence again and again\n" * 1000
+    payload = classgit.Compressor(None, "zlib").pack("notes.md", data)
+
+    assert payload.startswith(classgit.PACKED_MAGIC + b"zlib -\n")
+    assert len(payload) < len(data)
+    assert classgit.unpack(payload, None) == data
+
+
+def test_incompressible_data_is_stored_raw():
+    data = classgit.FRAME_PREFIX + bytes(range(256)) * 16
+    compressor = classgit.Compressor(None, "zlib")
+
+    assert classgit.unpack(compressor.pack("scan.md", data), None) == data
+    assert compressor.pack("scan.pdf", b"x" * 4096) == b"x" * 4096  # a type never compressed
+
+
+def test_push_pull_round_trip_with_compression(devices):
+    a, b = devices(2, compression="zlib")
+    round_trip(a, b)
+
+    write_courses(a, {"S1/long.md": "the same sentence again and again\n" * 1000})
+    stats = a.push().compression[".md"]
+    assert stats["files"] == 1 and stats["compressed"] < stats["bytes"] // 10
+    b.pull()
+    assert read_courses(b) == read_courses(a)
@@ -0,0 +1,51 @@
+import os
+import time
+from contextlib import closing
+
+import classgit
+from conftest import read_courses, write_courses
+
+
+def test_pulled_files_are_not_encrypted_again(devices):
+    a, b = devices(2)
+    write_courses(a, {"S1/n1.md": "note 1\n", "S1/n2.md": "note 2\n"})
+    a.push()
+    b.pull()
+
+    record = b.push()
+    assert (record.status, record.files) == ("noop", 0)
+
+
+def test_touched_files_are_hashed_not_encrypted(devices):
+    a, = devices(1)
+    write_courses(a, {"S1/n1.md": "note 1\n"})
+    a.push()
+    os.utime(a.path / "courses" / "S1" / "n1.md", ns=(time.time_ns(), time.time_ns()))
+
+    assert a.push().files == 0
+
+
+def test_racy_stat_is_never_trusted(devices):
+    a, b = devices(2)
+    note = a.path / "courses" / "S1" / "n1.md"
+    write_courses(a, {"S1/n1.md": "note 1\n"})
+    a.push()
+    with a.active(), closing(classgit.open_index()) as index:
+        assert classgit.index_get(index, "S1/n1.md")["mtime_ns"] == 0  # written within RACY_WINDOW_NS
+
+    # same size, same mtime: only the content tells the edit apart
+    st = note.stat()
+    note.write_text("note 2\n")
+    os.utime(note, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert a.push().files == 1
+    b.pull()
+    assert read_courses(b) == read_courses(a)
+
+
+def test_index_schema_is_migrated(tmp_path):
+    db = classgit.open_db(tmp_path / "index.sqlite", classgit._INDEX_MIGRATIONS)
+    assert db.execute("PRAGMA user_version").fetchone()[0] == len(classgit._INDEX_MIGRATIONS)
+    assert classgit.index_get(db, "missing.md") is None
+    db.close()
+    db = classgit.open_db(tmp_path / "index.sqlite", classgit._INDEX_MIGRATIONS)
+    assert db.execute("PRAGMA user_version").fetchone()[0] == len(classgit._INDEX_MIGRATIONS)
@@ -0,0 +1,45 @@
+import subprocess
+
+import classgit
+from conftest import read_courses, round_trip, write_courses
+
+
+def tree(ws, *paths):
+    listing = subprocess.run(["git", "ls-tree", "-r", "main", "--", *paths], cwd=ws.path,
+                             capture_output=True, text=True, check=True).stdout.splitlines()
+    return {line.split("\t")[1]: line.split()[2] for line in listing}
+
+
+def test_identical_files_share_their_ciphertext(devices):
+    a, = devices(1)
+    write_courses(a, {"S1/n1.md": "same\n", "S2/n1.md": "same\n", "S2/n2.md": "other\n"})
+    a.push()
+
+    blobs = tree(a, "encrypted/")
+    assert blobs["encrypted/S1/n1.md.age"] == blobs["encrypted/S2/n1.md.age"]
+    assert blobs["encrypted/S2/n2.md.age"] != blobs["encrypted/S1/n1.md.age"]
+
+
+def test_push_pull_round_trip_with_the_content_layout(devices):
+    a, b = devices(2, layout="content")
+    round_trip(a, b)
+
+    paths = tree(a)
+    assert classgit.MANIFEST_PATH in paths
+    assert not any(path.startswith("encrypted/") for path in paths)
+    assert not any("Math" in path or "notes" in path for path in paths)
+
+
+def test_switching_layouts(devices):
+    a, b = devices(2)
+    write_courses(a, {"S1/n1.md": "note 1\n", "S1/n2.md": "note 2\n"})
+    a.push()
+    b.pull()
+    (a.path / "config" / "layout.txt").write_text("content\n")
+    a.push()
+    assert classgit.MANIFEST_PATH in tree(a)
+
+    write_courses(a, {"S1/n2.md": "note 2, edited\n"})
+    a.push()
+    b.pull()
+    assert read_courses(b) == read_courses(a)
@@ -0,0 +1,23 @@
+import classgit
+from conftest import write_courses
+
+
+def test_push_and_pull_schedule_maintenance(devices, monkeypatch):
+    a, b = devices(2)
+    scheduled = []
+    monkeypatch.setattr(classgit, "schedule_maintenance", lambda: scheduled.append(classgit.LOCAL_DIR))
+    write_courses(a, {"S1/n1.md": "note 1\n"})
+    a.push()
+    b.pull()
+
+    assert scheduled == [a.path, b.path]
+
+
+def test_maintenance_is_due_once_packs_pile_up(devices):
+    a, = devices(1)
+    with a.active():
+        assert not classgit.maintenance_due({"count": 0, "packs": 1})
+        assert classgit.maintenance_due({"count": 5, "packs": 1})
+        classgit.MAINTENANCE_LOG.write_text('{"started": %f}\n' % classgit.time.time())
+        assert not classgit.maintenance_due({"count": 5, "packs": 1})
+        assert classgit.maintenance_due({"count": 0, "packs": classgit.MAINTENANCE_MAX_PACKS})
@@ -0,0 +1,42 @@
+import pytest
+
+import classgit
+from conftest import write_courses
+
+
+def samples(path):
+    return dict(line.rsplit(" ", 1) for line in path.read_text().splitlines()
+                if not line.startswith("#"))
+
+
+def test_metrics_of_recorded_runs(devices, tmp_path):
+    a, b = devices(2)
+    write_courses(a, {"S1/n1.md": "note 1\n", "S1/n2.md": "note 2\n"})
+    a.push()
+    a.push()
+    b.pull()
+
+    a.metrics(tmp_path / "a.prom")
+    b.metrics(tmp_path / "b.prom")
+    pushed, pulled = samples(tmp_path / "a.prom"), samples(tmp_path / "b.prom")
+    assert pushed['classgit_runs_total{command="push",status="ok"}'] == "1"
+    assert pushed['classgit_runs_total{command="push",status="noop"}'] == "1"
+    assert pushed['classgit_files_total{command="push"}'] == "2"
+    assert pushed['classgit_run_duration_seconds_count{command="push"}'] == "2"
+    assert pushed['classgit_run_duration_seconds_bucket{command="push",le="+Inf"}'] == "2"
+    assert pulled['classgit_last_run_success{command="pull"}'] == "1"
+    assert pulled['classgit_last_run_files{command="pull"}'] == "2"
+
+
+def test_metrics_before_the_first_run(tmp_path):
+    (tmp_path / "ws" / "config").mkdir(parents=True)
+    classgit.Workspace(tmp_path / "ws").metrics(tmp_path / "out.prom")
+
+    assert samples(tmp_path / "out.prom") == {}
+    assert not (tmp_path / "ws" / "config" / "history.sqlite").exists()
+
+
+def test_metrics_of_a_workspace_never_set_up(tmp_path):
+    with pytest.raises(classgit.NotSetUpError):
+        classgit.Workspace(tmp_path / "missing").metrics(tmp_path / "out.prom")
+    assert not (tmp_path / "out.prom").exists()
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from conftest import read_courses, write_courses
+
+
+def recorder(ws):
+    events = []
+    ws.on_progress = lambda event, path, size: events.append((event, path))
+    return events
+
+
+@pytest.mark.parametrize("storage", ["mirror", "objects"])
+def test_moves_reuse_ciphertext_and_plaintext(devices, storage):
+    a, b = devices(2, storage=storage)
+    write_courses(a, {"S1/n1.md": "note 1\n", "S1/n2.md": "note 2\n", "S1/n3.md": "note 3\n"})
+    a.push()
+    b.pull()
+    courses = a.path / "courses"
+    os.replace(courses / "S1", courses / "Archive")
+    os.replace(courses / "Archive" / "n3.md", courses / "Archive" / "renamed.md")
+
+    events = recorder(a)
+    assert a.push().bytes == 0
+    assert sorted(events) == [("moved", "Archive/n1.md"), ("moved", "Archive/n2.md"),
+                              ("moved", "Archive/renamed.md")]
+
+    events = recorder(b)
+    b.pull()
+    assert sorted(events) == [("moved", "Archive/n1.md"), ("moved", "Archive/n2.md"),
+                              ("moved", "Archive/renamed.md")]
+    assert read_courses(b) == read_courses(a)
+    assert not (b.path / "courses" / "S1").exists()
+
+
+@pytest.mark.parametrize("storage", ["mirror", "objects"])
+def test_swapped_files(devices, storage):
+    a, b = devices(2, storage=storage)
+    write_courses(a, {"S1/n1.md": "note 1\n", "S1/n2.md": "note 2\n"})
+    a.push()
+    b.pull()
+    courses = a.path / "courses" / "S1"
+    os.replace(courses / "n1.md", courses / "tmp")
+    os.replace(courses / "n2.md", courses / "n1.md")
+    os.replace(courses / "tmp", courses / "n2.md")
+
+    a.push()
+    b.pull()
+    assert read_courses(b) == {"S1/n1.md": b"note 2\n", "S1/n2.md": b"note 1\n"}
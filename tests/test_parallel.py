@@ -0,0 +1,45 @@
+import threading
+import time
+
+import classgit
+
+
+def test_results_come_back_in_input_order():
+    def work(n):
+        time.sleep((n % 5) / 1000)
+        if n % 7 == 0:
+            raise ValueError(n)
+        return n * n
+
+    items = list(range(200))  # several windows of jobs * 16 items
+    results = list(classgit.run_parallel(work, items, size=lambda n: n % 5, jobs=4))
+
+    assert [item for item, _, _ in results] == items
+    for item, result, error in results:
+        if item % 7 == 0:
+            assert isinstance(error, ValueError) and result is None
+        else:
+            assert (result, error) == (item * item, None)
+
+
+def test_each_window_starts_largest_first():
+    started = []
+    results = classgit.run_parallel(started.append, [3, 1, 4, 1, 5], size=lambda n: n, jobs=1)
+
+    assert [item for item, _, _ in results] == [3, 1, 4, 1, 5]
+    assert started == [5, 4, 3, 1, 1]
+
+
+def test_no_more_workers_than_jobs():
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def work(_):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.002)
+        with lock:
+            running[0] -= 1
+
+    list(classgit.run_parallel(work, range(50), jobs=3))
+    assert peak[0] <= 3
@@ -0,0 +1,15 @@
+import subprocess
+
+from conftest import round_trip
+
+
+def test_push_pull_round_trip_with_parts(devices):
+    a, b = devices(2, part_size=0.5)
+    round_trip(a, b)
+
+    listing = subprocess.run(["git", "ls-tree", "-r", "-l", "main", "chunks/"], cwd=a.path,
+                             capture_output=True, text=True, check=True).stdout.splitlines()
+    sizes = [int(line.split()[3]) for line in listing]
+    # big.pdf and notes.txt, in parts no bigger than the limit plus age's overhead
+    assert len(sizes) >= 3 + 6
+    assert max(sizes) < (1 << 19) + 4096
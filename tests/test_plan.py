@@ -0,0 +1,61 @@
+import subprocess
+
+from conftest import read_courses, write_courses
+
+
+def recorder(ws):
+    events = []
+    ws.on_progress = lambda event, path, size: events.append((event, path))
+    return events
+
+
+def fetch(ws):
+    subprocess.run(["git", "fetch", "-q", "origin"], cwd=ws.path, check=True)
+
+
+def test_plans_match_what_push_and_pull_do(devices):
+    a, b = devices(2)
+    write_courses(a, {"S1/n1.md": "note 1\n", "S1/n2.md": "note 2\n", "S2/n3.md": "note 3\n"})
+    a.push()
+    b.pull()
+    write_courses(a, {"S1/n1.md": "note 1, edited\n", "S2/new.md": "new\n"})
+    (a.path / "courses" / "S2" / "n3.md").rename(a.path / "courses" / "S2" / "n4.md")
+    (a.path / "courses" / "S1" / "n2.md").unlink()
+
+    plan = a.plan("push")
+    events = recorder(a)
+    a.push()
+
+    assert sorted(entry["path"] for entry in plan["encrypt"]) == ["S1/n1.md", "S2/new.md"]
+    assert plan["move"] == [{"path": "S2/n4.md", "from": "S2/n3.md"}]
+    assert plan["remove"] == ["S1/n2.md"]
+    assert sorted(path for event, path in events if event == "encrypted") == ["S1/n1.md", "S2/new.md"]
+
+    fetch(b)
+    plan = b.plan("pull")
+    events = recorder(b)
+    b.pull()
+
+    assert sorted(entry["path"] for entry in plan["decrypt"]) == ["S1/n1.md", "S2/new.md"]
+    assert plan["move"] == [{"path": "S2/n4.md", "from": "S2/n3.md"}]
+    assert plan["delete"] == ["S1/n2.md"]
+    assert sorted(path for event, path in events if event == "decrypted") == ["S1/n1.md", "S2/new.md"]
+    assert read_courses(b) == read_courses(a)
+
+
+def test_bundling_files_is_no_remote_change(devices):
+    a, b = devices(2)
+    write_courses(a, {f"S1/n{i}.md": f"note {i}\n" for i in range(4)})
+    a.push()
+    b.pull()
+    (a.path / "config" / "bundle_threshold.txt").write_text("4\n")
+
+    assert sorted(entry["path"] for entry in a.plan("push")["encrypt"]) == [
+        f"S1/n{i}.md" for i in range(4)]
+    a.push()
+    assert a.plan("push")["encrypt"] == []
+
+    fetch(b)
+    plan = b.plan("pull")
+    assert (plan["decrypt"], plan["move"], plan["delete"], plan["keep"]) == ([], [], [], [])
+    assert b.status()["remote"] == []
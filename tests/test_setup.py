@@ -0,0 +1,42 @@
+import argparse
+import subprocess
+
+import classgit
+
+
+def setup_args(workspace, repo_url=None, public_key=None):
+    return argparse.Namespace(command="setup", workspace=workspace,
+                              repo_url=repo_url, public_key=public_key)
+
+
+def fail_on_input(prompt):
+    raise AssertionError(f"setup asked: {prompt}")
+
+
+def test_setup_from_options(tmp_path, monkeypatch):
+    monkeypatch.setattr("builtins.input", fail_on_input)
+    for var in ("GIT_AUTHOR", "GIT_COMMITTER"):
+        monkeypatch.setenv(f"{var}_NAME", "ClassGit test")
+        monkeypatch.setenv(f"{var}_EMAIL", "test@classgit")
+    remote = tmp_path / "remote.git"
+    subprocess.run(["git", "init", "-q", "--bare", str(remote)], check=True)
+    config = tmp_path / "ws" / "config"
+    config.mkdir(parents=True)
+    public_key = classgit.generate_identity(config / "age_key.txt")
+
+    code, _ = classgit.run_command(setup_args(tmp_path / "ws", str(remote), public_key))
+
+    assert code == classgit.EXIT_OK
+    assert (config / "repo_url.txt").read_text() == str(remote)
+    assert (config / "public_key.txt").read_text() == public_key
+    assert (tmp_path / "ws" / ".git").is_dir()
+
+
+def test_setup_without_options_does_not_ask(tmp_path, monkeypatch):
+    monkeypatch.setattr("builtins.input", fail_on_input)
+
+    code, details = classgit.run_command(setup_args(tmp_path / "ws", repo_url="https://example.com/r.git"))
+
+    assert code == classgit.EXIT_USAGE
+    assert "--public-key" in details["error"] and "--repo-url" not in details["error"]
+    assert not (tmp_path / "ws" / "config").exists()
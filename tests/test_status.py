@@ -0,0 +1,40 @@
+import subprocess
+
+from conftest import write_courses
+
+
+def changes(entries):
+    return {entry["path"]: entry["change"] for entry in entries}
+
+
+def test_status_reports_both_sides(devices):
+    a, b = devices(2)
+    write_courses(a, {"S1/n1.md": "note 1\n", "S1/n2.md": "note 2\n", "S1/n3.md": "note 3\n"})
+    a.push()
+    b.pull()
+    assert b.status() == {"local": [], "remote": [], "conflicts": []}
+
+    write_courses(a, {"S1/n1.md": "note 1, from a\n", "S1/new.md": "new\n"})
+    (a.path / "courses" / "S1" / "n3.md").unlink()
+    a.push()
+    write_courses(b, {"S1/n1.md": "note 1, from b\n", "S1/n2.md": "note 2, from b\n",
+                      "S2/mine.md": "mine\n"})
+    assert changes(b.status()["remote"]) == {}  # not fetched yet
+
+    subprocess.run(["git", "fetch", "-q", "origin"], cwd=b.path, check=True)
+    report = b.status()
+    assert changes(report["local"]) == {"S1/n2.md": "modified", "S2/mine.md": "added"}
+    assert changes(report["remote"]) == {"S1/new.md": "added", "S1/n3.md": "deleted"}
+    assert changes(report["conflicts"]) == {"S1/n1.md": "modified here, modified remotely"}
+
+
+def test_status_after_sync_is_clean(devices):
+    a, b = devices(2)
+    write_courses(a, {"S1/n1.md": "note 1\n"})
+    a.sync()
+    b.sync()
+    write_courses(b, {"S1/n1.md": "note 1, edited\n"})
+    b.sync()
+    a.sync()
+
+    assert a.status() == b.status() == {"local": [], "remote": [], "conflicts": []}
@@ -0,0 +1,13 @@
+import pytest
+
+from conftest import round_trip
+
+
+@pytest.mark.parametrize("storage", ["mirror", "objects"])
+def test_push_pull_round_trip(devices, storage):
+    a, b = devices(2, storage=storage)
+    round_trip(a, b)
+
+    for ws in (a, b):
+        mirror = ws.path / "encrypted"
+        assert (mirror.is_dir() and any(mirror.rglob("*.age"))) == (storage == "mirror")
@@ -0,0 +1,84 @@
+import subprocess
+
+import pytest
+
+import classgit
+from conftest import read_courses, write_courses
+
+
+def conflict_copies(ws, name):
+    return sorted(path.name for path in (ws.path / "courses" / "S1").glob(f"{name} (conflict *"))
+
+
+def test_sync_keeps_both_versions_of_a_bundled_file(devices):
+    a, b = devices(2, bundle_threshold=4)
+    write_courses(a, {f"S1/n{i}.md": f"note {i}\n" for i in range(6)})
+    a.sync()
+    b.sync()
+    write_courses(a, {"S1/n5.md": "note 5\nfrom a\n"})
+    write_courses(b, {"S1/n5.md": "note 5\nfrom b\n"})
+    b.sync()
+
+    result = a.sync()
+
+    assert [entry["path"] for entry in result["conflicts"]] == ["S1/n5.md"]
+    copy, = conflict_copies(a, "n5")
+    assert read_courses(a)["S1/n5.md"] == b"note 5\nfrom b\n"
+    assert read_courses(a)[f"S1/{copy}"] == b"note 5\nfrom a\n"
+    b.sync()
+    assert read_courses(b) == read_courses(a)
+
+
+def test_sync_drops_copies_of_the_same_change(devices):
+    a, b = devices(2, bundle_threshold=4)
+    write_courses(a, {f"S1/n{i}.md": f"note {i}\n" for i in range(6)})
+    a.sync()
+    b.sync()
+    write_courses(a, {"S1/n1.md": "same\n"})
+    write_courses(b, {"S1/n1.md": "same\n"})
+    b.sync()
+
+    assert a.sync()["conflicts"] == []
+    assert conflict_copies(a, "n1") == []
+
+
+@pytest.mark.parametrize("settings", [{}, {"bundle_threshold": 4}], ids=["files", "bundles"])
+def test_pull_keeps_a_change_not_pushed_yet(devices, settings):
+    a, b = devices(2, **settings)
+    write_courses(a, {f"S1/n{i}.md": f"note {i}\n" for i in range(6)})
+    a.push()
+    b.pull()
+    write_courses(a, {"S1/n1.md": "note 1\nfrom a\n"})
+    a.push()
+    write_courses(b, {"S1/n1.md": "note 1\nfrom b\n"})
+
+    assert [entry["path"] for entry in b.pull().conflicts] == ["S1/n1.md"]
+    copy, = conflict_copies(b, "n1")
+    assert read_courses(b)["S1/n1.md"] == b"note 1\nfrom a\n"
+    assert read_courses(b)[f"S1/{copy}"] == b"note 1\nfrom b\n"
+
+
+def git(ws, *args):
+    return subprocess.run(["git", *args], cwd=ws.path, capture_output=True, text=True,
+                          check=True).stdout.split()
+
+
+def test_pull_only_fetches_what_changed(devices, monkeypatch):
+    a, b = devices(2)
+    write_courses(a, {f"S1/n{i}.md": f"note {i}\n" for i in range(6)})
+    a.sync()
+    b.sync()
+    before, = git(b, "rev-parse", "origin/main")
+    write_courses(a, {"S1/n1.md": "note 1, edited\n"})
+    a.sync()
+    b.sync()
+
+    after, = git(b, "rev-parse", "origin/main")
+    assert git(b, "rev-parse", after + "^") == [before]
+    fetched = git(b, "rev-list", "--objects", f"{before}..{after}")
+    assert [name for name in fetched if "/" in name] == ["encrypted/S1", "encrypted/S1/n1.md.age"]
+
+    monkeypatch.setattr(classgit, "SNAPSHOT_HISTORY", 2)
+    write_courses(a, {"S1/n2.md": "note 2, edited\n"})
+    a.sync()
+    assert git(a, "rev-list", "--count", "main") == ["1"]
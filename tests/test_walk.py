@@ -0,0 +1,76 @@
+import os
+import subprocess
+
+import pytest
+
+import classgit
+from conftest import write_courses
+
+# names whose order differs between plain string sorting and git's tree order
+TRICKY = ["a.md", "a/x.md", "a-b/y.md", "a.b/z.md", "a0.md", "ab/c/d.md", "B.md", "é.md"]
+
+
+def tree_order(ws):
+    """The course files of main, in git's tree order."""
+    listing = subprocess.run(["git", "ls-tree", "-r", "-z", "--name-only", "main", "encrypted/"],
+                             cwd=ws.path, capture_output=True, text=True, check=True).stdout
+    return [path[len("encrypted/"):-len(".age")] for path in listing.split("\0")[:-1]]
+
+
+def walk(ws, mirror, paths=None):
+    with ws.active():
+        actions = classgit.push_walk(mirror) if paths is None else classgit.journal_walk(mirror, paths)
+        return [(action, args[0]) for action, *args in actions]
+
+
+@pytest.mark.parametrize("storage", ["mirror", "objects"])
+def test_push_walk_matches_every_indexed_file(devices, storage):
+    a, = devices(1, storage=storage)
+    write_courses(a, {rel: rel for rel in TRICKY})
+    a.push()
+
+    actions = walk(a, storage == "mirror")
+    assert actions == [("file", rel) for rel in tree_order(a)]
+    assert sorted(tree_order(a)) == sorted(TRICKY)
+    assert a.push().status == "noop"
+
+
+@pytest.mark.parametrize("storage", ["mirror", "objects"])
+def test_push_walk_finds_what_went(devices, storage):
+    a, = devices(1, storage=storage)
+    write_courses(a, {rel: rel for rel in TRICKY})
+    a.push()
+    (a.path / "courses" / "a-b" / "y.md").unlink()
+    (a.path / "courses" / "a-b").rmdir()
+
+    actions = walk(a, storage == "mirror")
+    assert [rel for action, rel in actions if action == "file"] == [
+        rel for rel in tree_order(a) if rel != "a-b/y.md"]
+    assert ("delete", "encrypted/a-b/y.md.age") in actions
+    if storage == "mirror":
+        assert ("rmdir", str(a.path / "encrypted" / "a-b")) in actions
+
+
+@pytest.mark.parametrize("storage", ["mirror", "objects"])
+def test_journal_walk_agrees_with_push_walk(devices, storage):
+    a, = devices(1, storage=storage)
+    write_courses(a, {rel: rel for rel in TRICKY})
+    a.push()
+    courses = a.path / "courses"
+    (courses / "a-b" / "y.md").unlink()
+    (courses / "a-b").rmdir()
+    write_courses(a, {"a/new.md": "new", "a.b/z.md": "edited", "c/d/e.md": "new"})
+    journal = ["a", "a-b/y.md", "a-b", "c/d/e.md", "a/x.md"]
+
+    def under(item):
+        action, path = item
+        if action == "rmdir":
+            path = os.path.relpath(path, a.path / "encrypted")
+        elif action == "delete":
+            path = path[len("encrypted/"):-len(".age")]
+        return any(path == p or path.startswith(p + "/") for p in journal)
+
+    mirror = storage == "mirror"
+    expected = [item for item in walk(a, mirror) if under(item)]
+    assert ("delete", "encrypted/a-b/y.md.age") in expected and ("file", "c/d/e.md") in expected
+    assert sorted(walk(a, mirror, journal)) == sorted(expected)
@@ -0,0 +1,20 @@
+import threading
+
+from conftest import write_courses
+
+
+def test_workspaces_keep_their_own_run(devices):
+    a, b = devices(2)
+    write_courses(a, {"S1/n1.md": "note 1\n", "S1/n2.md": "note 2\n"})
+    results = {}
+    threads = [threading.Thread(target=lambda ws=ws, fn=fn: results.update({fn: getattr(ws, fn)()}))
+               for ws, fn in ((a, "push"), (b, "status"))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    b.pull()
+
+    assert a.last_run is results["push"] and a.last_run.command == "push"
+    assert a.last_run.files == 2
+    assert b.last_run.command == "pull" and b.last_run is not a.last_run